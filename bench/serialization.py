@@ -0,0 +1,117 @@
+"""Microbenchmark of rendering of JSON responses.
+
+Compares the number of pages rendered per second by Eve's renderer and
+by the fast renderer (see `renderers`) on pages of people with embedded
+memberships and organizations, as returned for
+`people?max_results=50&embed=["memberships.organization"]`. Checks that
+both renderers produce identical output.
+
+Usage:
+	python bench/serialization.py [number of pages]
+"""
+
+import os.path
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import simplejson
+from bson.objectid import ObjectId
+from flask import Flask
+from eve.io.mongo.mongo import MongoJSONEncoder
+
+import settings
+import renderers
+
+PAGE_SIZE = 50
+MEMBERSHIPS = 5
+
+
+def timestamps(i):
+	updated = datetime(2015, 1, 1) + timedelta(minutes=i % 20)
+	return {'created_at': datetime(2014, 12, 1), 'updated_at': updated}
+
+
+def organization(i):
+	return dict(timestamps(i), **{
+		'id': str(ObjectId()),
+		'name': 'Klub poslanců %d' % i,
+		'classification': 'parliamentary group',
+		'founding_date': '2013-10-26',
+		'identifiers': [{'identifier': str(i), 'scheme': 'psp.cz/organy'}],
+		'sources': [{'url': 'http://psp.cz/sqw/snem.sqw?id=%d' % i}],
+	})
+
+
+def membership(i, person_id):
+	return dict(timestamps(i), **{
+		'id': str(ObjectId()),
+		'person_id': person_id,
+		'organization_id': str(i),
+		'role': 'member',
+		'start_date': '2013-11-25',
+		'organization': organization(i),
+	})
+
+
+def person(i):
+	id = str(ObjectId())
+	return dict(timestamps(i), **{
+		'id': id,
+		'name': 'Jan Novák %d' % i,
+		'given_name': 'Jan',
+		'family_name': 'Novák',
+		'gender': 'male',
+		'birth_date': '1960-01-%02d' % (i % 28 + 1),
+		'identifiers': [{'identifier': str(i), 'scheme': 'psp.cz/osoby'}],
+		'contact_details': [{'type': 'email', 'value': 'jan.novak%d@example.com' % i}],
+		'memberships': [membership(i * MEMBERSHIPS + j, id) for j in range(MEMBERSHIPS)],
+		'_links': {'self': {'title': 'person', 'href': 'people/' + id}},
+	})
+
+
+def page(n):
+	return {
+		'_items': [person(n * PAGE_SIZE + i) for i in range(PAGE_SIZE)],
+		'_links': {
+			'self': {'title': 'people', 'href': 'people'},
+			'next': {'title': 'next page', 'href': 'people?page=%d' % (n + 2)},
+		},
+		'_meta': {'page': n + 1, 'max_results': PAGE_SIZE, 'total': 10000},
+	}
+
+
+def benchmark(label, render, pages):
+	start = time.perf_counter()
+	for p in pages:
+		render(p)
+	elapsed = time.perf_counter() - start
+	print('%-30s %10.1f pages/s' % (label, len(pages) / elapsed))
+
+
+def main():
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	pages = [page(i) for i in range(n)]
+	app = Flask(__name__)
+	app.config.update(settings.common)
+	date_format = settings.common['DATE_FORMAT']
+	sort_keys = settings.common.get('JSON_SORT_KEYS', False)
+
+	def eve_render(data):
+		return simplejson.dumps(data, cls=MongoJSONEncoder, sort_keys=sort_keys)
+
+	def fast_render(data):
+		return renderers.dumps(data, date_format, sort_keys)
+
+	with app.app_context():
+		for p in pages:
+			if eve_render(p) != fast_render(p):
+				raise ValueError('different output of the renderers')
+		benchmark('Eve renderer', eve_render, pages)
+		benchmark('fast renderer', fast_render, pages)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,96 @@
+"""Microbenchmark of validation of documents against resource schemas.
+
+Compares the number of documents validated per second by Cerberus and
+by the compiled schemas (see `schema_compiler`) used for bulk inserts.
+Rules requiring database lookups are skipped in both cases, for bulk
+inserts they are resolved by a few batched queries beforehand.
+
+Usage:
+	python bench/validation.py [number of documents]
+"""
+
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+import schema_compiler
+from run import VpapiValidator, FORMATS
+
+
+class BenchValidator(VpapiValidator):
+	"""Validator without the rules requiring database lookups."""
+	def _validate_unique(self, unique, field, value):
+		pass
+
+	def _validate_data_relation(self, data_relation, field, value):
+		pass
+
+	def _validate_disjoint(self, disjoint, field, value):
+		pass
+
+
+def person(i):
+	return {
+		'id': str(i),
+		'name': 'Jan Novák %d' % i,
+		'given_name': 'Jan',
+		'family_name': 'Novák',
+		'sort_name': 'Novák, Jan',
+		'gender': 'male',
+		'birth_date': '1960-01-%02d' % (i % 28 + 1),
+		'email': 'jan.novak%d@example.com' % i,
+		'identifiers': [
+			{'identifier': str(i), 'scheme': 'psp.cz/osoby'},
+			{'identifier': 'N%d' % i, 'scheme': 'wikidata'},
+		],
+		'other_names': [
+			{'name': 'Honza Novák', 'note': 'nickname', 'start_date': '1990', 'end_date': '2000-05'},
+		],
+		'contact_details': [
+			{'type': 'email', 'value': 'jan.novak%d@example.com' % i, 'label': 'E-mail'},
+			{'type': 'tel', 'value': '+420 123 456 789'},
+		],
+		'links': [
+			{'url': 'http://example.com/%d' % i, 'note': 'homepage'},
+		],
+		'sources': [
+			{'url': 'http://psp.cz/sqw/detail.sqw?id=%d' % i},
+		],
+	}
+
+
+def vote(i):
+	return {
+		'vote_event_id': str(i // 200),
+		'voter_id': str(i % 200),
+		'option': 'yes',
+		'group_id': str(i % 7),
+	}
+
+
+def benchmark(label, validate, documents):
+	start = time.perf_counter()
+	for document in documents:
+		if not validate(document):
+			raise ValueError('invalid document %s' % document)
+	elapsed = time.perf_counter() - start
+	print('%-30s %10.0f documents/s' % (label, len(documents) / elapsed))
+
+
+def main():
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	domain = settings.common['DOMAIN']
+	for resource, generate in (('people', person), ('votes', vote)):
+		schema = domain[resource]['schema']
+		documents = [generate(i) for i in range(n)]
+		validator = BenchValidator(schema)
+		compiled = schema_compiler.compile_schema(schema, FORMATS)
+		benchmark(resource + ' (Cerberus)', validator.validate, documents)
+		benchmark(resource + ' (compiled)', lambda document: compiled(validator, document), documents)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,241 @@
+"""Caches used by the API to avoid repeated reading of the same data
+from the database.
+"""
+
+import os
+import os.path
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+	"""A cache holding at most `max_size` entries. When the limit is
+	reached, the least recently used entries are evicted.
+
+	Counts cache hits, misses and evictions to allow monitoring of the
+	cache efficiency. All operations are thread-safe.
+	"""
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def get(self, key, default=None):
+		"""Returns the cached value for the key or `default` if there
+		is none. Marks the entry as the most recently used one.
+		"""
+		with self.lock:
+			try:
+				value = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			self.entries[key] = value
+			self.hits += 1
+			return value
+
+	def set(self, key, value):
+		"""Stores the value for the key, evicting the least recently
+		used entries if the cache is full.
+		"""
+		if self.max_size <= 0: return
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = value
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def setdefault(self, key, value):
+		"""Returns the cached value for the key if present, otherwise
+		stores and returns the given value. Does not affect the counters.
+		"""
+		with self.lock:
+			if key in self.entries:
+				return self.entries[key]
+		self.set(key, value)
+		return value
+
+	def delete(self, key):
+		"""Removes the entry for the key if present."""
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		"""Removes all entries."""
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		"""Returns a dictionary with the cache usage counters."""
+		return {
+			'size': len(self.entries),
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
+
+
+class DiskCache(object):
+	"""A cache storing entries as files in a directory, so that they
+	are shared by all processes on the machine and survive restarts.
+	When the directory contains more than `max_size` entries, the least
+	recently used ones are evicted. Supports the same operations and
+	counters as `LRUCache` except `setdefault`.
+
+	Values must be picklable. Keys are hashed, so their `repr` must
+	identify them.
+	"""
+	def __init__(self, directory, max_size):
+		self.directory = directory
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		os.makedirs(directory, exist_ok=True)
+		self.size = len(self._entry_files())
+
+	def __len__(self):
+		return len(self._entry_files())
+
+	def __contains__(self, key):
+		return os.path.exists(self._path(key))
+
+	def get(self, key, default=None):
+		"""Returns the cached value for the key or `default` if there
+		is none. Marks the entry as the most recently used one.
+		"""
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as f:
+				value = pickle.load(f)
+			os.utime(path, None)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			with self.lock:
+				self.misses += 1
+			return default
+		with self.lock:
+			self.hits += 1
+		return value
+
+	def set(self, key, value):
+		"""Stores the value for the key, evicting the least recently
+		used entries if the cache is full.
+		"""
+		if self.max_size <= 0: return
+		fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(temp, self._path(key))
+		except:
+			os.remove(temp)
+			raise
+		with self.lock:
+			self.size += 1
+			if self.size <= self.max_size: return
+			self._evict()
+
+	def delete(self, key):
+		"""Removes the entry for the key if present."""
+		try:
+			os.remove(self._path(key))
+		except FileNotFoundError:
+			pass
+
+	def clear(self):
+		"""Removes all entries."""
+		with self.lock:
+			for name in self._entry_files():
+				self._remove(name)
+			self.size = 0
+
+	def stats(self):
+		"""Returns a dictionary with the cache usage counters."""
+		return {
+			'size': len(self),
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
+
+	def _evict(self):
+		"""Removes the least recently used entries to free a tenth of
+		the cache, so that the directory is not listed on every `set`.
+		Entries are ordered by the time of their last use.
+		"""
+		entries = []
+		for name in self._entry_files():
+			try:
+				entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+			except FileNotFoundError:
+				pass
+		entries.sort()
+		keep = self.max_size - self.max_size // 10
+		for _, name in entries[:max(len(entries) - keep, 0)]:
+			if self._remove(name):
+				self.evictions += 1
+		self.size = min(len(entries), keep)
+
+	def _remove(self, name):
+		try:
+			os.remove(os.path.join(self.directory, name))
+			return True
+		except FileNotFoundError:
+			return False
+
+	def _entry_files(self):
+		return [name for name in os.listdir(self.directory) if name.endswith('.cache')]
+
+	def _path(self, key):
+		return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.cache')
+
+
+def make_cache(backend, max_size, directory=None):
+	"""Returns a cache of the given backend, `memory` for `LRUCache`
+	private to the process or `disk` for `DiskCache` in the directory,
+	or None if the backend is None.
+	"""
+	if backend is None:
+		return None
+	if backend == 'memory':
+		return LRUCache(max_size)
+	if backend == 'disk':
+		return DiskCache(directory, max_size)
+	raise ValueError('Unknown cache backend `%s`' % backend)
+
+
+# Collection holding generations of resources, see `bump_generation`.
+GENERATIONS_COLLECTION = '_generations'
+
+
+def load_generations(db):
+	"""Returns a dictionary mapping resource names to their current
+	generations stored in the database.
+	"""
+	return {doc['_id']: doc['generation'] for doc in db[GENERATIONS_COLLECTION].find()}
+
+
+def bump_generation(db, resource):
+	"""Increments generation of the resource in the database.
+
+	Cached data derived from a resource are keyed by its generation, so
+	incrementing it invalidates them in all processes serving the API
+	at once. Must be called after the change of the resource has been
+	written, otherwise a concurrent request could cache the old data
+	under the new generation.
+	"""
+	db[GENERATIONS_COLLECTION].update({'_id': resource}, {'$inc': {'generation': 1}}, upsert=True)
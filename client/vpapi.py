@@ -1,5 +1,7 @@
 import json
+import gzip
 import base64
+import urllib.parse
 from datetime import datetime, date, time
 
 import requests
@@ -22,6 +24,8 @@ LOCAL_TIMEZONE = None
 PAYLOAD_HEADERS = {
 	'Content-Type': 'application/json',
 }
+# payloads larger than this number of bytes are sent gzip-compressed (None = never)
+COMPRESSION_THRESHOLD = 65536
 
 
 def _endpoint(method, resource, id=None):
@@ -42,6 +46,18 @@ def _endpoint(method, resource, id=None):
 	return url
 
 
+def _payload(data):
+	"""Returns the body and headers of a request sending `data` as JSON,
+	gzip-compressed if the JSON is larger than `COMPRESSION_THRESHOLD`.
+	"""
+	body = json.dumps(data).encode('utf-8')
+	if COMPRESSION_THRESHOLD is None or len(body) <= COMPRESSION_THRESHOLD:
+		return body, PAYLOAD_HEADERS
+	headers = dict(PAYLOAD_HEADERS)
+	headers['Content-Encoding'] = 'gzip'
+	return gzip.compress(body), headers
+
+
 def _jsonify_dict_values(params):
 	"""Returns `params` dictionary with all values of type dictionary
 	or list serialized to JSON. This is necessary for _requests_
@@ -100,14 +116,30 @@ def getall(resource, **kwargs):
 		items = vpapi.getall(resource, where={...})
 		for i in items:
 			...
+
+	Pages are requested by their numbers unless a cursor is given by
+	the `after` parameter, e.g. `after=''` for the first page, in which
+	case each next page is requested by a cursor following the last
+	item of the previous page. Combine with `total='none'` to skip
+	counting of the items.
 	"""
-	page = 1
-	while True:
-		resp = get(resource, page=page, **kwargs)
-		for item in resp['_items']:
-			yield item
-		if 'next' not in resp['_links']: break
-		page += 1
+	if 'after' not in kwargs:
+		page = kwargs.pop('page', 1)
+		while True:
+			resp = get(resource, page=page, **kwargs)
+			for item in resp['_items']:
+				yield item
+			if 'next' not in resp['_links']: break
+			page += 1
+	else:
+		after = kwargs.pop('after')
+		while True:
+			resp = get(resource, after=after, **kwargs)
+			for item in resp['_items']:
+				yield item
+			if 'next' not in resp['_links']: break
+			query = urllib.parse.parse_qs(urllib.parse.urlparse(resp['_links']['next']['href']).query)
+			after = query['after'][0]
 
 
 def getfirst(resource, **kwargs):
@@ -128,11 +160,12 @@ def post(resource, data, **kwargs):
 	`data` contains dictionary with data of the entity(ies) to create
 	and eventual parameters may be specified as keyword arguments.
 	"""
+	body, headers = _payload(data)
 	resp = requests.post(
 		_endpoint('POST', resource),
 		params=_jsonify_dict_values(kwargs),
-		data=json.dumps(data),
-		headers=PAYLOAD_HEADERS,
+		data=body,
+		headers=headers,
 		verify=SERVER_CERT
 	)
 	resp.raise_for_status()
@@ -144,11 +177,12 @@ def put(resource, id, data, **kwargs):
 	`data` contains dictionary with data of the replacing entity and
 	eventual parameters may be specified as keyword arguments.
 	"""
+	body, headers = _payload(data)
 	resp = requests.put(
 		_endpoint('PUT', resource, id),
 		params=_jsonify_dict_values(kwargs),
-		data=json.dumps(data),
-		headers=PAYLOAD_HEADERS,
+		data=body,
+		headers=headers,
 		verify=SERVER_CERT
 	)
 	resp.raise_for_status()
@@ -160,11 +194,12 @@ def patch(resource, id, data, **kwargs):
 	`data` contains dictionary with fields to update and their new values,
 	eventual parameters may be specified as keyword arguments.
 	"""
+	body, headers = _payload(data)
 	resp = requests.patch(
 		_endpoint('PATCH', resource, id),
 		params=_jsonify_dict_values(kwargs),
-		data=json.dumps(data),
-		headers=PAYLOAD_HEADERS,
+		data=body,
+		headers=headers,
 		verify=SERVER_CERT
 	)
 	resp.raise_for_status()
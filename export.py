@@ -0,0 +1,179 @@
+"""Export of all documents of a resource in a single streamed response.
+
+	.../export/<resource>?where={...}&projection={...}&format=csv
+
+The documents matching the `where` clause are read by a single database
+cursor and streamed as they are read, so memory usage does not depend
+on the number of exported documents. `where`, `projection` and `sort`
+parameters have the same meaning as for the resource endpoint.
+
+Supported formats are `ndjson` (default, one JSON document per line)
+and `csv` where fields of subdocuments are flattened into columns named
+by their dotted path (e.g. `birth_place.name`) and lists are serialized
+as JSON.
+
+Documents are exported in the same form as the resource endpoint returns
+them, i.e. without internal fields and with `changes` from the history.
+"""
+
+import io
+import csv
+import json
+from datetime import datetime
+
+from eve.io.mongo import Mongo
+from eve.utils import config, ParsedRequest, debug_error_message
+from flask import request, current_app, abort, Response, stream_with_context
+
+import history
+import pagination
+
+# number of documents read from the database and sent in a single chunk
+BATCH_SIZE = 500
+
+FORMATS = {
+	'ndjson': 'application/x-ndjson',
+	'csv': 'text/csv',
+}
+
+
+def export_resource(resource):
+	"""Streams all documents of the resource matching the query."""
+	resource = _resource_by_url(resource)
+	if resource is None:
+		abort(404)
+	format = request.args.get('format', 'ndjson')
+	if format not in FORMATS:
+		abort(400, description=debug_error_message('Unsupported export format `%s`' % format))
+
+	req = ParsedRequest()
+	req.where = request.args.get('where')
+	req.projection = request.args.get('projection')
+	req.sort = request.args.get('sort')
+	projection = _parse_projection(req.projection)
+	# Neither keyset pagination nor totals of the API's data layer apply
+	cursor = Mongo.find(current_app.data, resource, req, {})
+	with_changes = bool(config.DOMAIN[resource].get('track_changes')) and pagination.projected(projection, 'changes')
+	batches = _batches(resource, cursor, with_changes)
+	if format == 'csv':
+		columns = _columns(config.DOMAIN[resource]['schema'], projection)
+		chunks = _csv_chunks(columns, batches)
+	else:
+		chunks = _ndjson_chunks(batches)
+
+	resp = Response(stream_with_context(chunks), mimetype=FORMATS[format])
+	resp.headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+		config.DOMAIN[resource]['url'].replace('/', '_'), format)
+	return resp
+
+
+def _resource_by_url(url):
+	"""Returns name of the resource with the given URL or None."""
+	for resource, settings in config.DOMAIN.items():
+		if settings['url'] == url:
+			return resource
+	return None
+
+
+def _batches(resource, cursor, with_changes):
+	"""Yields lists of documents of the resource read from the cursor
+	without internal fields. If `with_changes` is true, changes from the
+	history are attached to the documents of each list by a single query.
+	"""
+	db = current_app.data.driver.db
+	batch = []
+	for document in cursor:
+		document.pop('_id', None)
+		document.pop(config.ETAG, None)
+		batch.append(document)
+		if len(batch) == BATCH_SIZE:
+			if with_changes:
+				history.attach_changes(db, resource, batch)
+			yield batch
+			batch = []
+	if batch:
+		if with_changes:
+			history.attach_changes(db, resource, batch)
+		yield batch
+
+
+def _ndjson_chunks(batches):
+	encoder = current_app.data.json_encoder_class(sort_keys=config.JSON_SORT_KEYS)
+	for batch in batches:
+		yield ''.join(encoder.encode(document) + '\n' for document in batch)
+
+
+def _csv_chunks(columns, batches):
+	encoder = current_app.data.json_encoder_class(sort_keys=config.JSON_SORT_KEYS)
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(columns)
+	for batch in batches:
+		for document in batch:
+			writer.writerow([_csv_value(_get_path(document, column), encoder) for column in columns])
+		yield buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate()
+	# Header of an empty export
+	if buffer.tell():
+		yield buffer.getvalue()
+
+
+def _parse_projection(projection):
+	"""Returns the `projection` URL query parameter parsed into
+	a dictionary or None if not given.
+	"""
+	if not projection:
+		return None
+	try:
+		projection = json.loads(projection)
+		if not isinstance(projection, dict):
+			raise ValueError
+	except ValueError:
+		abort(400, description=debug_error_message('Unable to parse `projection` clause'))
+	return projection
+
+
+def _columns(schema, projection):
+	"""Returns names of CSV columns for the fields of the schema, with
+	fields of subdocuments flattened. Only the top-level fields selected
+	by the parsed projection are included.
+	"""
+	inclusive = bool(projection) and any(projection.values())
+	fields = [config.ID_FIELD] + sorted(f for f in schema if f != config.ID_FIELD) + \
+		[config.DATE_CREATED, config.LAST_UPDATED]
+	columns = []
+	for field in fields:
+		if projection and field != config.ID_FIELD and \
+				(inclusive and not projection.get(field) or not inclusive and field in projection):
+			continue
+		columns.extend(_field_columns(field, schema.get(field, {})))
+	return columns
+
+
+def _field_columns(path, definition):
+	if definition.get('type') == 'dict' and 'schema' in definition:
+		columns = []
+		for field in sorted(definition['schema']):
+			columns.extend(_field_columns(path + '.' + field, definition['schema'][field]))
+		return columns
+	return [path]
+
+
+def _get_path(document, path):
+	"""Returns value at the dotted path in the document or None."""
+	for key in path.split('.'):
+		if not isinstance(document, dict):
+			return None
+		document = document.get(key)
+	return document
+
+
+def _csv_value(value, encoder):
+	if value is None:
+		return ''
+	if isinstance(value, datetime):
+		return value.strftime(config.DATE_FORMAT)
+	if isinstance(value, (list, dict)):
+		return encoder.encode(value)
+	return value
@@ -0,0 +1,182 @@
+"""Content-addressed store of mirrored files.
+
+Content of each mirrored file is stored once as a blob named by its
+SHA-256 hash
+
+	FILES_DIR/_blobs/<first two hex digits>/<hash>.<ext>
+
+and the public files of entities
+
+	FILES_DIR/<prefix>/<resource>/<id>/<field>.<ext>          (version 1)
+	FILES_DIR/<prefix>/<resource>/<id>/<field>.<n>.<ext>      (version n)
+
+are hard links to the blobs. Thus identical files referenced by many
+entities or parliaments occupy the space only once while public URLs of
+the files stay the same.
+
+Versions of the files of an entity are recorded in a manifest
+
+	FILES_DIR/<prefix>/<resource>/<id>/manifest.json
+
+mapping each field to the list of its versions, the oldest one first.
+Each version is a dictionary with `version`, `file`, `sha256`, `size`,
+`content_type`, `source` URL and `fetched_at` time.
+"""
+
+import os
+import os.path
+import re
+import glob
+import json
+import shutil
+import hashlib
+import mimetypes
+import tempfile
+from datetime import datetime
+
+BLOBS_DIR = '_blobs'
+MANIFEST_FILE = 'manifest.json'
+
+# Name of a public file, i.e. `<field>.<ext>` or `<field>.<n>.<ext>`.
+_file_name_re = re.compile(r'^([^.]+)\.(?:(\d+)\.)?([^.]+)$')
+
+
+def load_manifest(files_dir, entity_dir):
+	"""Returns the manifest of files of the entity stored in the given
+	directory. Files mirrored before introduction of the manifest are
+	moved to the blob store and recorded into a new manifest.
+	"""
+	try:
+		with open(os.path.join(entity_dir, MANIFEST_FILE), 'r') as f:
+			return json.load(f)
+	except FileNotFoundError:
+		pass
+
+	manifest = {}
+	for path in sorted(glob.glob(os.path.join(entity_dir, '*'))):
+		m = _file_name_re.match(os.path.basename(path))
+		if not m or os.path.basename(path) == MANIFEST_FILE or path.endswith('.tmp'): continue
+		field, n, ext = m.groups()
+		sha256 = file_hash(path)
+		blob = _blob_path(files_dir, sha256, ext)
+		if not os.path.exists(blob):
+			os.makedirs(os.path.dirname(blob), exist_ok=True)
+			_link(path, blob)
+		_link(blob, path)
+		manifest.setdefault(field, []).append({
+			'version': int(n or 1),
+			'file': os.path.basename(path),
+			'sha256': sha256,
+			'size': os.path.getsize(path),
+			'content_type': mimetypes.guess_type(path)[0],
+			'source': None,
+			'fetched_at': datetime.utcfromtimestamp(os.path.getmtime(path)).replace(microsecond=0).isoformat(),
+		})
+	for versions in manifest.values():
+		versions.sort(key=lambda v: v['version'])
+	if manifest:
+		save_manifest(entity_dir, manifest)
+	return manifest
+
+
+def save_manifest(entity_dir, manifest):
+	"""Atomically writes the manifest of files of the entity."""
+	os.makedirs(entity_dir, exist_ok=True)
+	fd, temp = tempfile.mkstemp(dir=entity_dir, suffix='.tmp')
+	with os.fdopen(fd, 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	os.replace(temp, os.path.join(entity_dir, MANIFEST_FILE))
+
+
+def current_version(manifest, field, file_name):
+	"""Returns version of the field stored in the given file or None."""
+	for version in manifest.get(field, []):
+		if version['file'] == file_name:
+			return version
+	return None
+
+
+def add_version(files_dir, entity_dir, manifest, field, path, ext, sha256, **info):
+	"""Stores the file at `path` with the given hash as a new version of
+	the field and records it into the manifest. The file is moved into
+	the blob store unless an identical blob is already there.
+
+	Returns the new version.
+	"""
+	versions = manifest.setdefault(field, [])
+	n = versions[-1]['version'] + 1 if versions else 1
+	name = field + '.' + ext if n == 1 else field + '.' + str(n) + '.' + ext
+
+	blob = _blob_path(files_dir, sha256, ext)
+	os.makedirs(os.path.dirname(blob), exist_ok=True)
+	if os.path.exists(blob):
+		os.remove(path)
+	else:
+		os.replace(path, blob)
+	os.makedirs(entity_dir, exist_ok=True)
+	_link(blob, os.path.join(entity_dir, name))
+
+	version = dict(info, version=n, file=name, sha256=sha256, size=os.path.getsize(blob),
+		fetched_at=datetime.utcnow().replace(microsecond=0).isoformat())
+	versions.append(version)
+	save_manifest(entity_dir, manifest)
+	return version
+
+
+def remove_files(files_dir, path):
+	"""Removes files of the entity or of all entities of a resource in
+	the given directory. Blobs not linked from any other entity are
+	removed too.
+	"""
+	blobs = set()
+	for manifest_file in glob.glob(os.path.join(path, MANIFEST_FILE)) + \
+			glob.glob(os.path.join(path, '*', MANIFEST_FILE)):
+		with open(manifest_file, 'r') as f:
+			manifest = json.load(f)
+		for field, versions in manifest.items():
+			for version in versions:
+				blobs.add(_blob_path(files_dir, version['sha256'], version['file'].rsplit('.', 1)[1]))
+	shutil.rmtree(path, ignore_errors=True)
+
+	# A blob with a single link is not used by any entity
+	for blob in blobs:
+		try:
+			if os.stat(blob).st_nlink == 1:
+				os.remove(blob)
+		except FileNotFoundError:
+			pass
+
+
+def temp_file(files_dir):
+	"""Creates a temporary file in the blob store to download a new file
+	into. Returns a pair (open file object, path).
+	"""
+	os.makedirs(os.path.join(files_dir, BLOBS_DIR), exist_ok=True)
+	fd, path = tempfile.mkstemp(dir=os.path.join(files_dir, BLOBS_DIR), suffix='.tmp')
+	return os.fdopen(fd, 'wb'), path
+
+
+def file_hash(path):
+	"""Returns SHA-256 hash of the file content."""
+	sha256 = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(65536), b''):
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+
+def _blob_path(files_dir, sha256, ext):
+	"""Returns path of the blob with the given hash."""
+	return os.path.join(files_dir, BLOBS_DIR, sha256[:2], sha256 + '.' + ext)
+
+
+def _link(source, target):
+	"""Replaces the target by a hard link to the source or by a copy if
+	linking is not possible.
+	"""
+	temp = target + '.tmp'
+	try:
+		os.link(source, temp)
+	except OSError:
+		shutil.copyfile(source, temp)
+	os.replace(temp, target)
@@ -0,0 +1,153 @@
+"""Storage of historical values of tracked properties.
+
+Former values of properties listed in `track_changes` of a resource are
+stored in a separate collection instead of the `changes` list inside the
+entity, so that frequently changing entities do not grow with every
+update. Each change is stored as a document
+
+	{'resource': ..., 'id': ..., 'property': ..., 'value': ..., 'start_date': ..., 'end_date': ...}
+
+where `start_date` and `end_date` are optional as in the `changes` list.
+
+Entities created before the history collection was introduced may still
+contain changes in the `changes` list. These are treated as older than
+any change in the history collection.
+"""
+
+from datetime import datetime, timedelta
+
+import pymongo
+
+# Collection holding the changes.
+HISTORY_COLLECTION = 'history'
+
+
+def build_changes(db, resource, fields, original, effective_date):
+	"""Creates changes holding original values of the given fields to
+	include into the history.
+	"""
+	if not fields: return []
+	end_dates = former_end_dates(db, resource, original['id'], fields)
+	for ch in original.get('changes', []):
+		if ch['property'] in end_dates and ch.get('end_date'):
+			end_dates[ch['property']].append(ch['end_date'])
+	return [_build_change(field, original, effective_date, end_dates[field]) for field in fields]
+
+
+def _build_change(field, original, effective_date, former_end_dates):
+	"""Creates a change holding original value of the field to include
+	into the list of changes.
+	"""
+	change = {
+		'property': field,
+		'value': original.get(field),
+		'end_date': _datestring_add(effective_date, -1),
+	}
+	# If there are older values of this property already present in history,
+	# then validity of the current value will start immediately after the most
+	# recent one.
+	if former_end_dates:
+		change['start_date'] = _datestring_add(max(former_end_dates), 1)
+
+	return change
+
+
+def _datestring_add(datestring, days):
+	"""Returns the date specified as string in ISO format with given
+	number of days added.
+	"""
+	return (datetime.strptime(datestring, '%Y-%m-%d') + timedelta(days=days)).date().isoformat()
+
+
+def add_changes(db, resource, id, changes):
+	"""Stores the changes of the entity. The changes are given in the
+	order they should be listed, i.e. the most recent one first.
+	"""
+	if not changes: return
+	# Changes are listed by descending _id, so they are inserted in the
+	# reverse order
+	db[HISTORY_COLLECTION].insert([dict(change, resource=resource, id=id) for change in reversed(changes)])
+
+
+def replace_changes(db, resource, id, changes):
+	"""Replaces all stored changes of the entity by the given ones."""
+	delete_changes(db, resource, id)
+	add_changes(db, resource, id, changes)
+
+
+def delete_changes(db, resource, id=None):
+	"""Deletes stored changes of the entity or of all entities of the
+	resource if id is not given.
+	"""
+	spec = {'resource': resource}
+	if id is not None:
+		spec['id'] = id
+	db[HISTORY_COLLECTION].remove(spec)
+
+
+def former_end_dates(db, resource, id, properties):
+	"""Returns a dictionary mapping each of the given properties to the
+	list of end dates of its stored changes.
+	"""
+	end_dates = {p: [] for p in properties}
+	if not properties: return end_dates
+	results = db[HISTORY_COLLECTION].find(
+		{'resource': resource, 'id': id, 'property': {'$in': list(properties)}, 'end_date': {'$ne': None}},
+		{'_id': False, 'property': True, 'end_date': True})
+	for result in results:
+		end_dates[result['property']].append(result['end_date'])
+	return end_dates
+
+
+def load_changes(db, resource, ids):
+	"""Returns a dictionary mapping each of the given entity id-s to the
+	list of its stored changes, the most recent one first. All changes
+	are retrieved by a single query.
+	"""
+	changes = {}
+	results = db[HISTORY_COLLECTION].find(
+		{'resource': resource, 'id': {'$in': list(ids)}},
+		{'_id': False, 'resource': False}).sort([('_id', pymongo.DESCENDING)])
+	for result in results:
+		changes.setdefault(result.pop('id'), []).append(result)
+	return changes
+
+
+def attach_changes(db, resource, documents):
+	"""Lists the stored changes of all the given entities of the resource
+	in their `changes` property, followed by the changes stored inside
+	the entities. All changes are retrieved by a single query.
+	"""
+	if not documents: return
+	changes = load_changes(db, resource, [doc['id'] for doc in documents])
+	for doc in documents:
+		# Changes stored inside the entity are older than the ones in history
+		doc_changes = changes.get(doc['id'], []) + doc.get('changes', [])
+		if doc_changes:
+			doc['changes'] = doc_changes
+		else:
+			doc.pop('changes', None)
+
+
+def load_values_as_of(db, resource, ids, as_of):
+	"""Returns a dictionary mapping each of the given entity id-s to a
+	dictionary of properties whose values valid at the given date differ
+	from the current ones. Each property is mapped to the change holding
+	the value valid at the date. All changes are retrieved by a single
+	query.
+
+	The value valid at the date is the one of the change with the
+	earliest end date not before the date.
+	"""
+	found = {}
+	results = db[HISTORY_COLLECTION].find(
+		{'resource': resource, 'id': {'$in': list(ids)}, 'end_date': {'$gte': as_of}},
+		{'_id': False, 'id': True, 'property': True, 'value': True, 'end_date': True})
+	for result in results:
+		key = (result['id'], result['property'])
+		if key not in found or result['end_date'] < found[key]['end_date']:
+			found[key] = result
+	values = {}
+	for (id, property), change in found.items():
+		values.setdefault(id, {})[property] = change
+	return values
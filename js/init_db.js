@@ -12,6 +12,7 @@ db.people.ensureIndex({"name": 1});
 db.people.ensureIndex({"identifiers.identifier": 1});
 db.people.ensureIndex({"family_name": 1});
 db.people.ensureIndex({"sort_name": 1});
+db.people.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Organizations
 db.createCollection("organizations", {"primaryKey": {"id": 1, "_id": 1}});
@@ -20,6 +21,7 @@ db.organizations.ensureIndex({"identifiers.identifier": 1});
 db.organizations.ensureIndex({"classification": 1});
 db.organizations.ensureIndex({"parent_id": 1});
 db.organizations.ensureIndex({"area_id": 1}, {"sparse": true});
+db.organizations.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Memberships
 db.createCollection("memberships", {"primaryKey": {"id": 1, "_id": 1}});
@@ -28,12 +30,14 @@ db.memberships.ensureIndex({"organization_id": 1});
 db.memberships.ensureIndex({"on_behalf_of_id": 1}, {"sparse": true});
 db.memberships.ensureIndex({"post_id": 1}, {"sparse": true});
 db.memberships.ensureIndex({"area_id": 1}, {"sparse": true});
+db.memberships.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Posts
 db.createCollection("posts", {"primaryKey": {"id": 1, "_id": 1}});
 db.posts.ensureIndex({"label": 1});
 db.posts.ensureIndex({"organization_id": 1});
 db.posts.ensureIndex({"area_id": 1}, {"sparse": true});
+db.posts.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Areas
 db.createCollection("areas", {"primaryKey": {"id": 1, "_id": 1}});
@@ -41,6 +45,7 @@ db.areas.ensureIndex({"name": 1});
 db.areas.ensureIndex({"identifier": 1});
 db.areas.ensureIndex({"classification": 1});
 db.areas.ensureIndex({"parent_id": 1});
+db.areas.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Motions
 db.createCollection("motions", {"primaryKey": {"id": 1, "_id": 1}});
@@ -49,8 +54,9 @@ db.motions.ensureIndex({"legislative_session_id": 1});
 db.motions.ensureIndex({"identifier": 1});  // for the case of global identifiers
 db.motions.ensureIndex({"creator_id": 1});
 db.motions.ensureIndex({"text": "hashed"});  // hashed because of 1024B key size limit
-db.motions.ensureIndex({"date": 1});
+db.motions.ensureIndex({"date": 1, "id": 1});  // covers also {"date": 1} and used in keyset pagination
 db.motions.ensureIndex({"sources.url": 1});
+db.motions.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Vote events
 db.createCollection("vote_events", {"primaryKey": {"id": 1, "_id": 1}});
@@ -58,10 +64,11 @@ db.vote_events.ensureIndex({"organization_id": 1, "legislative_session_id": 1, "
 db.vote_events.ensureIndex({"legislative_session_id": 1});
 db.vote_events.ensureIndex({"identifier": 1});  // for the case of global identifiers
 db.vote_events.ensureIndex({"motion_id": 1});
-db.vote_events.ensureIndex({"start_date": 1});
+db.vote_events.ensureIndex({"start_date": 1, "id": 1});  // covers also {"start_date": 1} and used in keyset pagination
 db.vote_events.ensureIndex({"end_date": 1});
 db.vote_events.ensureIndex({"sources.url": 1});
 db.vote_events.ensureIndex({"organization_id": 1, "legislative_session_id": 1, "start_date": 1});  // potential sorting
+db.vote_events.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Votes
 db.createCollection("votes", {"primaryKey": {"id": 1, "_id": 1}});
@@ -69,25 +76,32 @@ db.votes.ensureIndex({"vote_event_id": 1});
 db.votes.ensureIndex({"voter_id": 1, "vote_event_id": 1});  // covers also {"voter_id": 1}
 db.votes.ensureIndex({"group_id": 1, "vote_event_id": 1});  // covers also {"group_id": 1}
 db.votes.ensureIndex({"pair_id": 1}, {"sparse": true});
+db.votes.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Speeches
 db.createCollection("speeches", {"primaryKey": {"id": 1, "_id": 1}});
 db.speeches.ensureIndex({"creator_id": 1, "date": 1, "position": 1});  // covers also {"creator_id": 1}
 db.speeches.ensureIndex({"event_id": 1, "date": 1, "position": 1});  // covers also {"event_id": 1} and used in import to SayIt
-db.speeches.ensureIndex({"date": 1, "position": 1});  // covers also {"date": 1}
+db.speeches.ensureIndex({"date": 1, "position": 1, "id": 1});  // covers also {"date": 1} and used in keyset pagination
 db.speeches.ensureIndex({"text": "hashed"});  // hashed because of 1024B key size limit
 db.speeches.ensureIndex({"sources.url": 1});
-db.speeches.ensureIndex({"updated_at": 1});  // used in import to SayIt
+db.speeches.ensureIndex({"updated_at": 1, "id": 1});  // used in import to SayIt, in keyset pagination and in snapshots
 
 // Events
 db.createCollection("events", {"primaryKey": {"id": 1, "_id": 1}});
 db.events.ensureIndex({"name": 1});
 db.events.ensureIndex({"organization_id": 1, "type": 1, "identifier": 1});  // covers also {"organization_id": 1}
 db.events.ensureIndex({"identifier": 1});  // for the case of global identifiers
-db.events.ensureIndex({"start_date": 1});
+db.events.ensureIndex({"start_date": 1, "id": 1});  // covers also {"start_date": 1} and used in keyset pagination
 db.events.ensureIndex({"end_date": 1});
 db.events.ensureIndex({"parent_id": 1});
+db.events.ensureIndex({"updated_at": 1});  // used in snapshots
 
 // Logs
 db.createCollection("logs", {"primaryKey": {"id": 1, "_id": 1}});
 db.logs.ensureIndex({"created_at": 1});
+db.logs.ensureIndex({"updated_at": 1});  // used in snapshots
+
+// History of changes of tracked properties
+db.createCollection("history");
+db.history.ensureIndex({"resource": 1, "id": 1, "property": 1, "end_date": 1});  // covers also {"resource": 1, "id": 1}
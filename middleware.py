@@ -0,0 +1,231 @@
+"""WSGI middleware wrapping the dispatcher of parliament applications."""
+
+import io
+import re
+import zlib
+
+from werkzeug.wsgi import get_input_stream
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Media types of responses worth compressing.
+_compressible_re = re.compile(r'^(text/.*|application/(json|xml|x-ndjson|javascript|.*\+json|.*\+xml))$')
+
+# Suffix of entity tags of compressed responses, see `CompressionMiddleware`.
+_etag_suffix_re = re.compile(r'-(br|gzip|deflate)"')
+
+
+class CompressionMiddleware(object):
+	"""Compresses responses by gzip, deflate or brotli (if the `brotli`
+	module is installed) as negotiated by the `Accept-Encoding` header
+	of the request.
+
+	Responses shorter than `min_size` bytes are sent uncompressed.
+	Responses of unknown length, e.g. streamed exports, are compressed
+	chunk by chunk as they are produced, so they are never buffered
+	as a whole.
+
+	The compressed representation differs from the uncompressed one, so
+	its `ETag` gets the encoding as a suffix, e.g. `"abc-gzip"`. The
+	suffix is removed from `If-None-Match` and `If-Match` headers of
+	requests before they are passed to the application, so a tag of
+	either representation matches the current version of the resource.
+	"""
+	def __init__(self, app, min_size=1024, level=6):
+		self.app = app
+		self.min_size = min_size
+		self.level = level
+		self.encodings = (('br', ) if brotli else ()) + ('gzip', 'deflate')
+
+	def __call__(self, environ, start_response):
+		# encodings of the representations whose tags are in If-None-Match
+		matched = set(_etag_suffix_re.findall(environ.get('HTTP_IF_NONE_MATCH', '')))
+		if matched or _etag_suffix_re.search(environ.get('HTTP_IF_MATCH', '')):
+			environ = dict(environ)
+			for header in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH'):
+				if header in environ:
+					environ[header] = _etag_suffix_re.sub('"', environ[header])
+
+		encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), self.encodings)
+		if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+			return self.app(environ, start_response)
+
+		# compressor chosen by the headers of the response, if any
+		chosen = []
+
+		def compressing_start_response(status, headers, exc_info=None):
+			del chosen[:]
+			if self._compressible(status, headers):
+				headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+				headers.append(('Content-Encoding', encoding))
+				_add_vary(headers)
+				headers = _suffix_etag(headers, encoding)
+				chosen.append(_compressor(encoding, self.level))
+			elif status.startswith('304') and encoding in matched:
+				# Not modified compressed representation the client has
+				headers = _suffix_etag(headers, encoding)
+			return start_response(status, headers, exc_info)
+
+		app_iter = self.app(environ, compressing_start_response)
+		return _CompressedIterable(app_iter, chosen)
+
+	def _compressible(self, status, headers):
+		"""Tells if the response with the given status and headers is to
+		be compressed.
+		"""
+		if not status.startswith('200'):
+			return False
+		headers = {k.lower(): v for k, v in headers}
+		if 'content-encoding' in headers:
+			return False
+		if not _compressible_re.match(headers.get('content-type', '').split(';')[0].strip()):
+			return False
+		length = headers.get('content-length')
+		return length is None or int(length) >= self.min_size
+
+
+class _CompressedIterable(object):
+	"""Response body yielding the chunks of the application response
+	compressed by the chosen compressor or unchanged if none has been
+	chosen. Closes the application response when closed by the server,
+	even if it has not been iterated.
+	"""
+	def __init__(self, app_iter, chosen):
+		self.app_iter = app_iter
+		self.chosen = chosen
+
+	def __iter__(self):
+		for chunk in self.app_iter:
+			if not self.chosen:
+				yield chunk
+				continue
+			data = self.chosen[0].compress(chunk)
+			if data:
+				yield data
+		if self.chosen:
+			yield self.chosen[0].flush()
+
+	def close(self):
+		if hasattr(self.app_iter, 'close'):
+			self.app_iter.close()
+
+
+class DecompressionMiddleware(object):
+	"""Decompresses bodies of POST, PUT and PATCH requests sent with
+	`Content-Encoding: gzip` or `deflate` before passing them to the
+	application.
+
+	Requests whose decompressed body would exceed `max_size` bytes are
+	refused with `413 Request Entity Too Large` without decompressing
+	more than that, so a small compressed body cannot exhaust memory.
+	"""
+	def __init__(self, app, max_size):
+		self.app = app
+		self.max_size = max_size
+
+	def __call__(self, environ, start_response):
+		encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+		if not encoding or encoding == 'identity' or \
+				environ.get('REQUEST_METHOD') not in ('POST', 'PUT', 'PATCH'):
+			return self.app(environ, start_response)
+		if encoding not in ('gzip', 'deflate'):
+			return UnsupportedMediaType('Unsupported Content-Encoding `%s`' % encoding)(environ, start_response)
+		try:
+			body = self._decompress(get_input_stream(environ), encoding)
+		except (BadRequest, RequestEntityTooLarge) as e:
+			return e(environ, start_response)
+		environ = dict(environ)
+		del environ['HTTP_CONTENT_ENCODING']
+		environ['wsgi.input'] = io.BytesIO(body)
+		environ['CONTENT_LENGTH'] = str(len(body))
+		return self.app(environ, start_response)
+
+	def _decompress(self, stream, encoding):
+		"""Returns the decompressed content of the stream."""
+		wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+		decompressor = zlib.decompressobj(wbits)
+		body = io.BytesIO()
+		try:
+			for chunk in iter(lambda: stream.read(65536), b''):
+				# Never decompress more than one byte over the limit
+				while chunk:
+					body.write(decompressor.decompress(chunk, self.max_size - body.tell() + 1))
+					if body.tell() > self.max_size:
+						raise RequestEntityTooLarge()
+					chunk = decompressor.unconsumed_tail
+			body.write(decompressor.flush())
+		except zlib.error:
+			raise BadRequest('Invalid %s request body' % encoding)
+		if body.tell() > self.max_size:
+			raise RequestEntityTooLarge()
+		if not decompressor.eof:
+			raise BadRequest('Truncated %s request body' % encoding)
+		return body.getvalue()
+
+
+def negotiate_encoding(accept_encoding, encodings):
+	"""Returns the first of the `encodings` acceptable according to the
+	value of `Accept-Encoding` header with the highest quality, or None
+	if no compression is acceptable.
+	"""
+	qualities = {}
+	for item in accept_encoding.split(','):
+		parts = item.strip().split(';')
+		name = parts[0].strip().lower()
+		if not name: continue
+		q = 1.0
+		for param in parts[1:]:
+			key, _, value = param.strip().partition('=')
+			if key.strip() == 'q':
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		qualities[name] = q
+	best, best_q = None, 0.0
+	for encoding in encodings:
+		q = qualities.get(encoding, qualities.get('*', 0.0))
+		if q > best_q:
+			best, best_q = encoding, q
+	return best
+
+
+def _suffix_etag(headers, encoding):
+	"""Returns the headers with the encoding added to the `ETag`."""
+	return [(k, v[:-1] + '-' + encoding + '"' if k.lower() == 'etag' and v.endswith('"') else v)
+		for k, v in headers]
+
+
+def _add_vary(headers):
+	"""Adds `Accept-Encoding` to the `Vary` header of the response."""
+	for i, (k, v) in enumerate(headers):
+		if k.lower() == 'vary':
+			if 'accept-encoding' not in v.lower():
+				headers[i] = (k, v + ', Accept-Encoding')
+			return
+	headers.append(('Vary', 'Accept-Encoding'))
+
+
+class _BrotliCompressor(object):
+	"""Brotli compressor with the interface of zlib compressor objects."""
+	def __init__(self, level):
+		self.compressor = brotli.Compressor(quality=min(level, 11))
+
+	def compress(self, data):
+		return self.compressor.process(data)
+
+	def flush(self):
+		return self.compressor.finish()
+
+
+def _compressor(encoding, level):
+	"""Returns a streaming compressor for the encoding."""
+	if encoding == 'br':
+		return _BrotliCompressor(level)
+	# gzip and zlib container of deflate data, respectively
+	wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+	return zlib.compressobj(level, zlib.DEFLATED, wbits)
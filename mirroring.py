@@ -0,0 +1,206 @@
+"""Mirroring of remote files referenced in the fields listed in
+`save_files` of a resource.
+
+Files are downloaded by background workers after the document has been
+stored, see `mirror_file`. Once the local copy exists, the field of the
+document is updated to point to it.
+"""
+
+import os
+import os.path
+import time
+import hashlib
+import threading
+import urllib.parse
+from datetime import datetime
+
+import requests
+
+import history
+import filestore
+from cache import bump_generation
+
+
+def mirror_file(job):
+	"""Translates remote URL in the given field of the stored document
+	to a corresponding locally hosted file. Also if the field is newly
+	added or the remote file has changed, download it and store as a
+	new version of the file, see `filestore`.
+
+	ETag and Last-Modified of the remote file are remembered for each
+	version, so that the file is requested conditionally next time and
+	it is not transferred at all if it has not changed. If the server
+	does not provide them, the remote file is considered unchanged if
+	its length equals the length of the current version. Otherwise it
+	is downloaded and its hash is compared with the hash of the current
+	version.
+
+	If the remote URL does not exist, the field is set to the remote
+	URL.
+
+	For parliaments listed in `MIRROR_CONTENT_COMPARE` (e.g. sk/nrsr
+	with padded images) it is impossible to detect changed file by its
+	changed length, so unless the server supports conditional requests
+	the files are always downloaded and compared by hash.
+
+	:param job: dictionary with the database `db`, `resource`, `id`
+		of the document, mirrored `field`, remote `url`, `effective_date`
+		of the change, flag `track` if the change should be logged into
+		history and `config` with the API settings
+	"""
+	db, resource, field, config = job['db'], job['resource'], job['field'], job['config']
+	document = db[resource].find_one({'id': job['id']}, {'_id': False, 'id': True, field: True, 'changes': True})
+	if document is None: return
+
+	# Find the version of the file the field currently points to.
+	entity_dir = (config['FILES_DIR'] + '/' + config['URL_PREFIX'] + '/' +
+		resource + '/' + str(job['id']))
+	manifest = filestore.load_manifest(config['FILES_DIR'], entity_dir)
+	host = '%s://%s/' % (config['FILES_PROTOCOL'], config['FILES_HOST'])
+	current = urllib.parse.unquote(document.get(field) or '')
+	version = None
+	if current.startswith(host):
+		version = filestore.current_version(manifest, field, os.path.basename(current))
+
+	headers = {}
+	if version and version.get('source') == job['url']:
+		if version.get('etag'):
+			headers['If-None-Match'] = version['etag']
+		if version.get('last_modified'):
+			headers['If-Modified-Since'] = version['last_modified']
+
+	# Without validators a cheap HEAD request tells if the length of the file has changed.
+	if version and not headers and config['URL_PREFIX'] not in config['MIRROR_CONTENT_COMPARE']:
+		resp, _ = _request('head', job['url'], config)
+		if resp is None:
+			_store(job, document, job['url'])
+			return
+		if resp.headers.get('content-length') == str(version['size']):
+			return
+
+	# Download the remote file and compare it with the current version.
+	resp, download = _request('get', job['url'], config, headers, download=True)
+	if resp is None:
+		_store(job, document, job['url'])
+		return
+	if resp.status_code == 304:
+		return
+	path, sha256 = download
+	validators = {
+		'etag': resp.headers.get('etag'),
+		'last_modified': resp.headers.get('last-modified'),
+	}
+	if version and sha256 == version['sha256']:
+		os.remove(path)
+		# Remember the validators to make a conditional request next time
+		version.update(validators, source=job['url'])
+		filestore.save_manifest(entity_dir, manifest)
+		return
+
+	content_type = resp.headers.get('content-type', 'application/octet-stream').split(';')[0].strip()
+	ext = content_type.split('/')[-1]
+	version = filestore.add_version(config['FILES_DIR'], entity_dir, manifest, field, path, ext, sha256,
+		source=job['url'], content_type=content_type, **validators)
+
+	# Modify the field in the document to contain the local file.
+	url = config['FILES_HOST'] + '/' + config['URL_PREFIX'] + '/' + resource + '/' + \
+		str(job['id']) + '/' + version['file']
+	url = urllib.parse.quote(url)
+	_store(job, document, '%s://%s' % (config['FILES_PROTOCOL'], url))
+
+
+def _store(job, document, value):
+	"""Sets the field of the stored document to the new value unless
+	the field has been changed meanwhile. Logs the change into history
+	if changes of the field are tracked.
+	"""
+	db, resource, field, config = job['db'], job['resource'], job['field'], job['config']
+	current = document.get(field)
+	if value == current: return
+
+	# The stored ETag would not match the changed document, so it is
+	# removed to be computed again on the next request
+	result = db[resource].update(
+		{'id': job['id'], field: current},
+		{
+			'$set': {field: value, config['LAST_UPDATED']: datetime.utcnow().replace(microsecond=0)},
+			'$unset': {config['ETAG']: ''},
+		})
+	if not result or not result.get('n'): return
+
+	if job['track'] and current:
+		changes = history.build_changes(db, resource, [field], document, job['effective_date'])
+		history.add_changes(db, resource, job['id'], changes)
+	bump_generation(db, resource)
+
+
+# Session reusing connections to the remote hosts across jobs.
+_session = requests.Session()
+
+def _request(method, url, config, headers=None, download=False):
+	"""Sends the HTTP request to the URL. Requests to the same host are
+	limited to `MIRROR_HOST_CONCURRENCY` at the same time. Failed
+	requests are repeated `MIRROR_RETRIES` times with increasing delay
+	unless the server responds with a client error.
+
+	If `download` is set, the response body is streamed into a temporary
+	file in the blob store, see `_download`.
+
+	Returns a pair (response, download) where download is a pair (path
+	of the downloaded file, its SHA-256 hash) or None if nothing has
+	been downloaded. The response is None if the request failed.
+	"""
+	semaphore = _host_semaphore(urllib.parse.urlparse(url).netloc, config['MIRROR_HOST_CONCURRENCY'])
+	for attempt in range(config['MIRROR_RETRIES'] + 1):
+		if attempt:
+			time.sleep(config['MIRROR_RETRY_DELAY'] * 2 ** (attempt - 1))
+		try:
+			with semaphore:
+				resp = _session.request(method, url, headers=headers, allow_redirects=True,
+					timeout=config['MIRROR_TIMEOUT'], stream=True)
+				try:
+					if resp.status_code >= 500:
+						continue
+					resp.raise_for_status()
+					if not download or resp.status_code == 304:
+						return resp, None
+					return resp, _download(resp, config['FILES_DIR'])
+				finally:
+					resp.close()
+		except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+				requests.exceptions.ChunkedEncodingError):
+			continue
+		except requests.exceptions.RequestException:
+			return None, None
+	return None, None
+
+
+def _download(resp, files_dir):
+	"""Streams the response body into a temporary file in chunks while
+	computing its hash, so that memory usage does not depend on the
+	size of the file.
+
+	Returns a pair (path of the file, SHA-256 hash of the content).
+	"""
+	f, path = filestore.temp_file(files_dir)
+	sha256 = hashlib.sha256()
+	try:
+		with f:
+			for chunk in resp.iter_content(65536):
+				f.write(chunk)
+				sha256.update(chunk)
+	except:
+		os.remove(path)
+		raise
+	return path, sha256.hexdigest()
+
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+def _host_semaphore(host, limit):
+	"""Returns the semaphore limiting concurrent requests to the host."""
+	with _host_semaphores_lock:
+		if host not in _host_semaphores:
+			_host_semaphores[host] = threading.BoundedSemaphore(limit)
+		return _host_semaphores[host]
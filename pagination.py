@@ -0,0 +1,291 @@
+"""Keyset (cursor) pagination of resources.
+
+Instead of skipping documents of the previous pages, the next page is
+requested by `after` URL query parameter containing an opaque cursor
+that identifies the last document of the previous page. The documents
+following it in the sort order are found by the index, so each page
+costs the same regardless of its position. Example:
+
+	.../vote-events?sort=start_date&after=WyIyMDE0LTAxLTAyIiwgIjEyMyJd
+
+An empty `after` parameter requests the first page. Link to the next
+page is provided in `_links` if a document follows the page and
+`_meta.total` is the number of all documents matching the query.
+
+Documents are sorted by the `id` primary key or by one of the sort keys
+listed in `keyset_sorts` of the resource with `id` appended to make the
+order unique. Each sort key needs a corresponding index.
+
+Counting of all documents matching the query for `_meta.total` may cost
+more than fetching the page. URL query parameter `total` (or `total` of
+the resource by default) chooses how the total is obtained:
+
+	exact   counted for each request
+	cached  counted once and cached until the resource is changed
+	none    not provided, only the existence of the next page is found
+"""
+
+import ast
+import json
+import base64
+import urllib.parse
+from datetime import datetime
+
+from eve.utils import config, debug_error_message
+from eve.methods.common import resource_link
+from flask import request, abort
+
+CURSOR_PARAM = 'after'
+TOTAL_PARAM = 'total'
+TOTAL_MODES = ('exact', 'cached', 'none')
+
+
+def keyset_sort(resource, sort):
+	"""Returns the list of (field, direction) pairs to sort the resource
+	by for keyset pagination given the `sort` URL query parameter.
+	"""
+	fields = parse_sort(sort) if sort else []
+	if fields and fields[-1][0] == config.ID_FIELD:
+		fields.pop()
+	directions = set(direction for _, direction in fields)
+	allowed = config.DOMAIN[resource].get('keyset_sorts', ())
+	if len(directions) > 1 or fields and tuple(f for f, _ in fields) not in allowed:
+		abort(400, description=debug_error_message(
+			'Sorting by `%s` is not supported with `%s`' % (sort, CURSOR_PARAM)))
+	return fields + [(config.ID_FIELD, directions.pop() if directions else 1)]
+
+
+def keyset_query(sort, cursor):
+	"""Returns a query for documents following the document identified
+	by the cursor in the given sort order.
+
+	Documents with null or missing value of a field are sorted before
+	all other values in ascending order and after them in descending
+	order.
+	"""
+	values = decode_cursor(cursor, len(sort))
+	branches = []
+	for i, (field, direction) in enumerate(sort):
+		equal = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+		value = values[i]
+		if value is None:
+			if direction == 1:
+				branches.append(dict(equal, **{field: {'$ne': None}}))
+		elif direction == 1:
+			branches.append(dict(equal, **{field: {'$gt': value}}))
+		else:
+			branches.append(dict(equal, **{field: {'$lt': value}}))
+			branches.append(dict(equal, **{field: None}))
+	return {'$or': branches} if branches else {config.ID_FIELD: {'$exists': False}}
+
+
+def encode_cursor(document, sort):
+	"""Returns the cursor identifying the document in the sort order."""
+	values = []
+	for field, _ in sort:
+		value = document.get(field)
+		if isinstance(value, datetime):
+			value = value.strftime(config.DATE_FORMAT)
+		values.append(value)
+	return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+	"""Returns the list of values of sort fields encoded in the cursor.
+	Values of datetime fields are converted back by Eve together with
+	the rest of the query.
+	"""
+	try:
+		values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+		if not isinstance(values, list) or len(values) != length:
+			raise ValueError
+	except (ValueError, TypeError, UnicodeError):
+		abort(400, description=debug_error_message('Unable to parse `%s` cursor' % CURSOR_PARAM))
+	return values
+
+
+def projection_with_sort(projection, sort):
+	"""Returns the client's projection (JSON string of the `projection`
+	URL query parameter or None) extended by the sort fields needed to
+	create the cursor, and the list of fields added.
+
+	Fields Eve always returns (id and the timestamps) are never added,
+	so they are never removed from the documents.
+	"""
+	if not projection: return projection, []
+	try:
+		parsed = json.loads(projection)
+		if not isinstance(parsed, dict):
+			raise ValueError
+	except ValueError:
+		# Let Eve report the invalid projection
+		return projection, []
+	projection = parsed
+	added = []
+	inclusive = any(projection.values())
+	for field, _ in sort:
+		if field in (config.ID_FIELD, config.LAST_UPDATED, config.DATE_CREATED):
+			continue
+		if inclusive and not projection.get(field):
+			projection[field] = 1
+			added.append(field)
+		elif not inclusive and field in projection:
+			del projection[field]
+			added.append(field)
+	return json.dumps(projection), added
+
+
+def projected(projection, field):
+	"""Returns True if the field is included by the projection given
+	as a dictionary or None for all fields.
+	"""
+	if not projection: return True
+	if any(projection.values()):
+		return bool(projection.get(field))
+	return projection.get(field, 1) != 0
+
+
+def total_mode(resource):
+	"""Returns the requested way of computing the total number of
+	documents, see `TOTAL_MODES`.
+	"""
+	mode = request.args.get(TOTAL_PARAM, config.DOMAIN[resource].get('total', 'exact'))
+	if mode not in TOTAL_MODES:
+		abort(400, description=debug_error_message('Unable to parse `%s` parameter' % TOTAL_PARAM))
+	return mode
+
+
+def count_key(resource, req, lookup):
+	"""Returns a key identifying the query of the request in the cache
+	of totals. Equivalent `where` clauses differing in formatting or
+	order of keys share the key. Pages of the same query requested by
+	`page` or by `after` share the total, so the cursor is not part of
+	the key.
+	"""
+	try:
+		where = json.dumps(json.loads(req.where), sort_keys=True) if req.where else None
+	except ValueError:
+		where = req.where
+	return (config.URL_PREFIX, resource, where, json.dumps(lookup, sort_keys=True, default=str))
+
+
+def next_link(cursor):
+	"""Returns link to the next page of the current request."""
+	args = [(k, v) for k, v in request.args.items(multi=True) if k not in (CURSOR_PARAM, config.QUERY_PAGE)]
+	args.append((CURSOR_PARAM, cursor))
+	return {'title': 'next page', 'href': resource_link() + '?' + urllib.parse.urlencode(args)}
+
+
+class PageCursor(object):
+	"""Wrapper of the database cursor of a page of documents that counts
+	all documents matching the query in the given `total` mode.
+
+	In `cached` mode the total is stored into `cache` under `key`. In
+	`none` mode the count is only a lower bound telling if there is a
+	next page, and the total and the link to the last page are removed
+	from the response.
+
+	The total is counted by `count_cursor`, which defaults to the cursor
+	of the page, unless it has been `counted` already in `exact` mode.
+	"""
+	def __init__(self, cursor, req, total, cache=None, key=None, count_cursor=None):
+		self.cursor = cursor
+		self.count_cursor = count_cursor or cursor
+		self.max_results = req.max_results
+		self.skip = (req.page - 1) * req.max_results if req.max_results else 0
+		self.total = total
+		self.cache = cache
+		self.key = key
+		self.probed = None
+		self.counted = None
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def count(self, with_limit_and_skip=False):
+		if with_limit_and_skip:
+			return self.cursor.count(True)
+		if self.total == 'none' and self.max_results:
+			return self.skip + self.probe()
+		if self.total == 'cached':
+			count = self.cache.get(self.key)
+			if count is None:
+				count = self.count_cursor.count()
+				self.cache.set(self.key, count)
+			return count
+		if self.counted is not None:
+			return self.counted
+		return self.count_cursor.count()
+
+	def probe(self):
+		"""Returns the number of documents of the page plus one if there
+		is a next page, counting at most one document behind the page.
+		"""
+		if self.probed is None:
+			self.probed = self.cursor.clone().limit(self.max_results + 1).count(True)
+		return self.probed
+
+	def extra(self, response):
+		if self.total == 'none':
+			response.get(config.META, {}).pop('total', None)
+			response.get(config.LINKS, {}).pop('last', None)
+
+
+class KeysetCursor(PageCursor):
+	"""Wrapper of the database cursor of a page of documents that
+	remembers the last document to create the link to the next page.
+
+	The cursor of the page is restricted to the documents following the
+	`after` cursor, so the total is counted by `count_cursor` of all
+	documents matching the query.
+
+	Fields needed for the cursor but not requested by the client's
+	projection are removed from the documents.
+	"""
+	def __init__(self, cursor, req, total, cache, key, count_cursor, sort, hidden_fields):
+		super().__init__(cursor, req, total, cache, key, count_cursor)
+		self.sort = sort
+		self.hidden_fields = hidden_fields
+		self.returned = 0
+		self.last_cursor = None
+
+	def __iter__(self):
+		for document in self.cursor:
+			self.returned += 1
+			self.last_cursor = encode_cursor(document, self.sort)
+			for field in self.hidden_fields:
+				document.pop(field, None)
+			yield document
+
+	def extra(self, response):
+		"""Replaces the page number based links to other pages by a link
+		to the next page with the cursor.
+		"""
+		links = response.get(config.LINKS)
+		if links is not None:
+			for rel in ('next', 'prev', 'last'):
+				links.pop(rel, None)
+			more = self.max_results and self.returned == self.max_results and self.probe() > self.max_results
+			if self.last_cursor is not None and more:
+				links['next'] = next_link(self.last_cursor)
+		super().extra(response)
+
+
+def parse_sort(sort):
+	"""Parses the `sort` URL query parameter in either Mongo syntax,
+	e.g. [("date", -1)], or comma delimited syntax, e.g. "-date,id", into
+	the list of (field, direction) pairs.
+	"""
+	try:
+		fields = ast.literal_eval(sort)
+		return [(str(field), -1 if direction == -1 else 1) for field, direction in fields]
+	except (ValueError, SyntaxError, TypeError):
+		pass
+	fields = []
+	for field in sort.split(','):
+		field = field.strip()
+		if field.startswith('-'):
+			fields.append((field[1:], -1))
+		elif field:
+			fields.append((field, 1))
+	return fields
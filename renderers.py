@@ -0,0 +1,65 @@
+"""Fast rendering of JSON responses.
+
+Eve renders JSON responses by simplejson with the JSON encoder of the
+data layer, whose `default` method is called through several levels of
+inheritance for each datetime and ObjectId and formats each datetime by
+`DATE_FORMAT` again. Embedded pages contain thousands of them.
+
+`render_json` produces output identical to Eve's renderer by the
+C accelerated encoder of the standard library with a single `default`
+function that handles the BSON values directly and formats each
+distinct datetime only once. Responses containing values the fast
+encoder does not know are rendered by Eve's renderer.
+"""
+
+import json
+from datetime import datetime, date, time
+
+import eve.render
+from eve.io.mongo.mongo import MongoJSONEncoder
+from bson.objectid import ObjectId
+from flask import current_app
+
+# Eve's renderer used when the fast one is disabled or not applicable.
+eve_render_json = eve.render.render_json
+
+
+def render_json(data):
+	"""Renders the response data to JSON, by the fast encoder if enabled
+	by `FAST_JSON` setting.
+	"""
+	if not current_app.config.get('FAST_JSON') or current_app.data.json_encoder_class is not MongoJSONEncoder:
+		return eve_render_json(data)
+	try:
+		return dumps(data, current_app.config['DATE_FORMAT'], current_app.config['JSON_SORT_KEYS'])
+	except TypeError:
+		return eve_render_json(data)
+
+
+def install():
+	"""Makes Eve render JSON responses by `render_json`."""
+	eve.render.render_json = render_json
+
+
+def dumps(data, date_format, sort_keys=False):
+	"""Returns the data serialized to JSON in the same way as Eve does.
+	Raises TypeError for values Eve's Mongo encoder does not handle.
+	"""
+	# formatted naive datetimes, many documents share the same ones
+	formatted = {}
+
+	def default(value):
+		if isinstance(value, datetime):
+			if value.tzinfo is not None:
+				return value.strftime(date_format)
+			result = formatted.get(value)
+			if result is None:
+				result = formatted[value] = value.strftime(date_format)
+			return result
+		if isinstance(value, ObjectId):
+			return str(value)
+		if isinstance(value, (time, date)):
+			return value.isoformat()
+		raise TypeError(repr(value) + ' is not JSON serializable')
+
+	return json.dumps(data, default=default, sort_keys=sort_keys)
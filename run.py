@@ -6,24 +6,38 @@ validations and authorization implementation.
 """
 
 import re
+import time
 from datetime import datetime, date, timedelta
 import os
 import os.path
-import glob
-import shutil
 import json
-import urllib.parse
+import threading
+import copy
+import hashlib
+from collections import OrderedDict
+from xml.sax.saxutils import escape as xml_escape
 
-import requests
 from eve import Eve
-from eve.io.mongo import Validator
+from eve.io.mongo import Mongo, Validator
 from eve.auth import BasicAuth
-from eve.utils import config, debug_error_message
-from flask import request, current_app, Flask, jsonify, Response, abort
+from eve.utils import config, debug_error_message, parse_request
+from eve.render import _best_mime
+from flask import request, current_app, Flask, Response, abort, g
 from flask.ext.cors import CORS
 from bson.objectid import ObjectId
 
 import settings
+from cache import LRUCache, make_cache, load_generations, bump_generation
+import history
+from workers import WorkerPool
+from mirroring import mirror_file
+from snapshots import build_snapshot
+import filestore
+import schema_compiler
+import pagination
+import export
+import renderers
+from tenants import TenantEve, TenantMongo, tenant_settings, URL_PREFIX_PATTERN
 
 
 def on_fetched_item_callback(resource, response):
@@ -47,13 +61,9 @@ def on_fetched_item_callback(resource, response):
 	allows multilevel embedding.
 	"""
 	del response['_id']
-	if 'embed' in request.args:
-		try:
-			embed = json.loads(request.args['embed'])
-			for path in embed:
-				_embed_relation(resource, path, response, [(resource, response['id'])])
-		except:
-			abort(400, description=debug_error_message('Unable to parse `embed` clause'))
+	_attach_history(resource, [response])
+	_embed(resource, [response])
+	_embed_counts(resource, [response])
 
 
 def on_fetched_resource_callback(resource, response):
@@ -62,254 +72,1013 @@ def on_fetched_resource_callback(resource, response):
 	See `on_fetched_item_callback`. Example:
 
 	.../organizations?where={...}&embed=["memberships.person"]
+
+	Related entities are retrieved for the whole page of documents at
+	once, see `_embed_relation`.
 	"""
 	for item in response['_items']:
-		on_fetched_item_callback(resource, item)
+		del item['_id']
+	_attach_history(resource, response['_items'])
+	_embed(resource, response['_items'])
+	_embed_counts(resource, response['_items'])
+
+
+def _attach_history(resource, documents, in_projection=None):
+	"""Lists changes of tracked properties stored in the history into
+	the `changes` property of all the given documents of the resource.
+
+	If a date is given in the `as_of` URL query parameter, values of
+	tracked properties are replaced by the values valid at that date.
+	Example:
+
+	.../people?where={...}&as_of=2012-06-30
+
+	History of all documents is retrieved by a single query. Only the
+	fields for which `in_projection` returns True are changed, it
+	defaults to the projection of the request, see `_in_projection`.
+	"""
+	in_projection = in_projection or _in_projection
+	if not config.DOMAIN[resource].get('track_changes') or not documents: return
+	db = current_app.data.driver.db
+	ids = [doc['id'] for doc in documents]
+
+	if 'as_of' in request.args:
+		as_of = request.args['as_of']
+		try:
+			datetime.strptime(as_of, '%Y-%m-%d')
+		except ValueError:
+			abort(400, description=debug_error_message('Unable to parse `as_of` date'))
+		values = history.load_values_as_of(db, resource, ids, as_of)
+		for doc in documents:
+			found = values.get(doc['id'], {})
+			# Consider also changes stored inside the entity
+			for change in doc.get('changes', []):
+				if change.get('end_date') and change['end_date'] >= as_of and \
+						(change['property'] not in found or change['end_date'] < found[change['property']]['end_date']):
+					found[change['property']] = change
+			for field, change in found.items():
+				if not in_projection(field):
+					continue
+				if change['value'] is None:
+					doc.pop(field, None)
+				else:
+					doc[field] = change['value']
+
+	if in_projection('changes'):
+		history.attach_changes(db, resource, documents)
 
 
-def _embed_relation(resource, path, document, ancestors):
+def _in_projection(field):
+	"""Returns True if the field is requested by the projection in the
+	`projection` URL query parameter.
+	"""
+	if 'projection' not in request.args: return True
+	try:
+		projection = json.loads(request.args['projection'])
+	except ValueError:
+		return True
+	if not isinstance(projection, dict):
+		return True
+	return pagination.projected(projection, field)
+
+
+def _embed(resource, documents):
+	"""Embeds related items requested in the `embed` URL query
+	parameter into all the given documents of the resource.
+	"""
+	if 'embed' not in request.args: return
+	embed = _parse_embed()
+	paths = [path for path, _ in embed]
+	for path, options in embed:
+		# Relations embedded deeper into the entities of this path
+		children = set(p[len(path)+1:].partition('.')[0] for p in paths if p.startswith(path + '.'))
+		_embed_relation(resource, path, [(doc, [(resource, doc['id'])]) for doc in documents], options, children)
+
+
+def _embed_counts(resource, documents):
+	"""Adds numbers of related items of relations requested in the
+	`embed_count` URL query parameter into all the given documents of
+	the resource. Example:
+
+	.../people?embed_count=["memberships", "votes"]
+
+	The numbers are stored in the field `_counts` of each document.
+	They are computed for all documents by a single grouped aggregation
+	per relation.
+	"""
+	if 'embed_count' not in request.args: return
+	try:
+		rel_names = json.loads(request.args['embed_count'])
+		if not isinstance(rel_names, list) or not all(isinstance(r, str) for r in rel_names):
+			raise ValueError
+	except ValueError:
+		abort(400, description=debug_error_message('Unable to parse `embed_count` clause'))
+
+	for rel_name in rel_names:
+		relation = config.DOMAIN[resource]['relations'].get(rel_name)
+		if not relation: continue
+		values = set(doc.get(relation['field']) for doc in documents)
+		values.discard(None)
+		counts = {}
+		if values:
+			related_resource = current_app.data.driver.db[relation['resource']]
+			results = related_resource.aggregate([
+				{'$match': {relation['fkey']: {'$in': list(values)}}},
+				{'$group': {'_id': '$' + relation['fkey'], 'count': {'$sum': 1}}},
+			])
+			counts = {result['_id']: result['count'] for result in results['result']}
+		for doc in documents:
+			doc.setdefault('_counts', {})[rel_name] = counts.get(doc.get(relation['field']), 0)
+
+
+def _parse_embed():
+	"""Parses the `embed` URL query parameter.
+
+	The parameter is either a list of relation paths or a dictionary
+	mapping relation paths to embedding options, e.g.
+
+	{"votes": {"max_results": 100, "sort": "-vote_event_id"}, "memberships.organization": {"projection": {"name": 1}}}
+
+	Returns list of pairs (relation path, options).
+	"""
+	try:
+		embed = json.loads(request.args['embed'])
+		if isinstance(embed, list):
+			embed = [(path, {}) for path in embed]
+		elif isinstance(embed, dict):
+			# Shorter paths first to embed parents before their children
+			embed = sorted(embed.items())
+		else:
+			raise ValueError
+		for path, options in embed:
+			if not isinstance(path, str) or not isinstance(options, dict):
+				raise ValueError
+			for option, value in options.items():
+				if option in ('max_results', 'page'):
+					if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+						raise ValueError
+				elif option == 'sort':
+					if not isinstance(value, str):
+						raise ValueError
+				elif option == 'projection':
+					if not isinstance(value, dict) or any(v not in (0, 1) for v in value.values()):
+						raise ValueError
+					# Mixed inclusive-exclusive projection is not allowed
+					if len(set(value.values())) > 1:
+						raise ValueError
+				else:
+					raise ValueError
+	except ValueError:
+		abort(400, description=debug_error_message('Unable to parse `embed` clause'))
+	return embed
+
+
+def _embed_relation(resource, path, targets, options, children):
 	"""Embeds entities of a given (eventually multilevel) relation into
-	the document.
+	the documents.
 
-	:param resource: resource of the document
+	:param resource: resource of the documents
 	:param path: dot separated chain of relation names
-	:param document: document to embed into
-	:param ancestors: list of entities on the current 'path' of embedding
-
-	List in the `ancestors` parameter containing tuples of resource
-	name and entity id is used to prevent embedding of an entity into
-	itself and to limit the depth of nested embedding.
+	:param targets: list of pairs (document to embed into, list of
+		entities on the current 'path' of embedding to the document)
+	:param options: embedding options for the last relation of the path
+	:param children: names of relations that will be embedded into the
+		entities of the last relation of the path later
+
+	List of ancestors containing tuples of resource name and entity id
+	is used to prevent embedding of an entity into itself and to limit
+	the depth of nested embedding.
+
+	Related entities of all the documents are retrieved by a single
+	query per relation and level of nesting instead of one query per
+	document. If paging of a plural relation is requested by options,
+	one page of entities is embedded into each document, see
+	`_embed_pages`.
 	"""
-	# Extract the topmost relation from the chain of relations and check
-	# if there is a reference to a related entity in the actual document
+	# Extract the topmost relation from the chain of relations and keep
+	# only documents with a reference to a related entity
 	rel_name, _, tail = path.partition('.')
 	relation = config.DOMAIN[resource]['relations'].get(rel_name)
-	if not relation or relation['field'] not in document: return
+	if not relation: return
+	targets = [(doc, ancestors) for doc, ancestors in targets if relation['field'] in doc]
+
+	# Retrieve the related entities for all documents that do not have
+	# them already embedded
+	pending = [(doc, ancestors) for doc, ancestors in targets if rel_name not in doc]
+	projection = None if tail else _embed_projection(relation, options, children)
+	if not tail and set(options) - {'projection'} and rel_name.endswith('s'):
+		_embed_pages(resource, rel_name, pending, options, projection)
+		pending = []
+	values = set(doc[relation['field']] for doc, _ in pending)
+	values.discard(None)
+	if values:
+		related = _find_related(relation, values, projection)
+		embedded = []
+		for doc, ancestors in pending:
+			entities = []
+			for result in related.get(doc[relation['field']], []):
+				# Prevent embedding of an entity into itself
+				if (relation['resource'], result['id']) in ancestors:
+					continue
+				# Entities are shared through the identity map, each document gets its own copy
+				result = _copy_document(result)
+				# Omit xxx_id property in embedded entity - it is redundant with id it references
+				if relation['fkey'] != 'id':
+					result.pop(relation['fkey'], None)
+				entities.append(result)
+			embedded.extend(entities)
+			if entities:
+				# Either entity or list of entities will be embedded depending on singular or plural of relation name
+				if rel_name.endswith('s'):
+					doc[rel_name] = entities
+				else:
+					doc[rel_name] = entities[0]
+				# Omit xxx_id property in embedding entity - it is redundant with id it references
+				if relation['field'] != 'id':
+					doc.pop(relation['field'])
+		_attach_history(relation['resource'], embedded, lambda field: pagination.projected(projection, field))
+
+	# Resolve deeper levels of embedding (limited to 3 levels) for all
+	# embedded entities at once
+	if tail:
+		subtargets = []
+		for doc, ancestors in targets:
+			if rel_name not in doc or len(ancestors) >= 3:
+				continue
+			for subdoc in _embedded_entities(doc[rel_name]):
+				subtargets.append((subdoc, ancestors + [(relation['resource'], subdoc['id'])]))
+		if subtargets:
+			_embed_relation(relation['resource'], tail, subtargets, options, children)
+
+
+def _embed_projection(relation, options, children):
+	"""Returns projection of the embedded entities of the relation
+	requested by the `projection` embedding option or None if all
+	fields are requested.
+
+	Fields `id`, the field referencing the embedding document and
+	fields referencing entities embedded deeper are always included
+	because they are needed to perform the embedding.
+	"""
+	projection = options.get('projection')
+	if not projection:
+		return None
+	relations = config.DOMAIN[relation['resource']]['relations']
+	required = set(['id', relation['fkey']])
+	required.update(relations[child]['field'] for child in children if child in relations)
+	if 1 in projection.values():
+		projection = dict(projection)
+		projection.update((field, 1) for field in required)
+	else:
+		projection = {k: v for k, v in projection.items() if k not in required}
+	return projection
+
+
+def _mongo_fields(projection):
+	"""Returns fields specification for a Mongo query with the given
+	projection that excludes the Mongo internal `_id` field.
+	"""
+	fields = dict(projection) if projection else {}
+	fields['_id'] = False
+	return fields
+
+
+def _projection_key(projection):
+	"""Returns a hashable key identifying the projection."""
+	return tuple(sorted(projection.items())) if projection else None
+
+
+def _embed_pages(resource, rel_name, targets, options, projection):
+	"""Embeds one page of entities of a plural relation into each of the
+	documents. The page is embedded in the same form as a collection
+	is returned by the API, i.e. a dictionary with `_items` containing
+	the entities, `_meta` with total number of entities and `_links`
+	to the neighbouring pages.
+
+	:param resource: resource of the documents
+	:param rel_name: name of the plural relation
+	:param targets: list of pairs (document to embed into, list of
+		entities on the current 'path' of embedding to the document)
+	:param options: paging options `max_results`, `page` and `sort`
+	:param projection: projection of the embedded entities
 
-	# Embed unless the entity is already embedded
-	if rel_name not in document:
-		# Retrieve the related entities
+	Ids of the entities on the pages of all documents and their totals
+	are retrieved by a single grouped aggregation and the entities
+	themselves by a single query.
+	"""
+	relation = config.DOMAIN[resource]['relations'][rel_name]
+	max_results = min(options.get('max_results', config.EMBED_PAGINATION_DEFAULT),
+		config.EMBED_PAGINATION_LIMIT)
+	page = options.get('page', 1)
+	skip = (page - 1) * max_results
+
+	values = set(doc[relation['field']] for doc, _ in targets)
+	values.discard(None)
+	pages = {}
+	entities = {}
+	if values:
 		related_resource = current_app.data.driver.db[relation['resource']]
-		value = document[relation['field']]
-		results = related_resource.find({relation['fkey']: value})
-		entities = []
-		for result in results:
+		pipeline = [{'$match': {relation['fkey']: {'$in': list(values)}}}]
+		if 'sort' in options:
+			pipeline.append({'$sort': OrderedDict(pagination.parse_sort(options['sort']))})
+		pipeline.append({'$group': {'_id': '$' + relation['fkey'], 'ids': {'$push': '$id'}, 'total': {'$sum': 1}}})
+		for result in related_resource.aggregate(pipeline)['result']:
+			pages[result['_id']] = (result['ids'][skip:skip + max_results], result['total'])
+		ids = set(id for page_ids, _ in pages.values() for id in page_ids)
+		if ids:
+			for result in related_resource.find({'id': {'$in': list(ids)}}, _mongo_fields(projection)):
+				entities[result['id']] = _remember_entity(relation['resource'], result, _projection_key(projection))
+
+	# Links to the neighbouring pages refer to the embedding document
+	# with the same embedding options except the page
+	def page_link(document, title, page):
+		embed = json.dumps({rel_name: dict(options, max_results=max_results, page=page)},
+			separators=(',', ':'), sort_keys=True)
+		href = '%s/%s?embed=%s' % (config.DOMAIN[resource]['url'], document['id'], embed)
+		return {'title': title, 'href': href}
+
+	embedded = []
+	for doc, ancestors in targets:
+		page_ids, total = pages.get(doc[relation['field']], ([], 0))
+		items = []
+		for id in page_ids:
 			# Prevent embedding of an entity into itself
-			if (relation['resource'], result['id']) in ancestors:
+			if (relation['resource'], id) in ancestors or id not in entities:
 				continue
-			result.pop('_id')
+			entity = _copy_document(entities[id])
 			# Omit xxx_id property in embedded entity - it is redundant with id it references
 			if relation['fkey'] != 'id':
-				result.pop(relation['fkey'])
-			entities.append(result)
-		if entities:
-			# Either entity or list of entities will be embedded depending on singular or plural of relation name
-			if rel_name.endswith('s'):
-				document[rel_name] = entities
-			else:
-				document[rel_name] = entities[0]
-			# Omit xxx_id property in embedding entity - it is redundant with id it references
-			if relation['field'] != 'id':
-				document.pop(relation['field'])
-
-	# Recursively resolve deeper levels of embedding (limited to 3 levels)
-	if tail and rel_name in document and len(ancestors) < 3:
-		entities = document[rel_name]
-		if not isinstance(entities, list):
-			entities = [entities]
-		for subdoc in entities:
-			ancestors.append((relation['resource'], subdoc['id']))
-			_embed_relation(relation['resource'], tail, subdoc, ancestors)
-			ancestors.pop()
+				entity.pop(relation['fkey'], None)
+			items.append(entity)
+		embedded.extend(items)
+
+		links = {}
+		if page * max_results < total:
+			links['next'] = page_link(doc, 'next page', page + 1)
+		if page > 1:
+			links['prev'] = page_link(doc, 'previous page', page - 1)
+
+		doc[rel_name] = {
+			'_items': items,
+			'_meta': {'page': page, 'max_results': max_results, 'total': total},
+			'_links': links,
+		}
+	_attach_history(relation['resource'], embedded, lambda field: pagination.projected(projection, field))
+
+
+def _embedded_entities(value):
+	"""Returns list of entities embedded in a field, regardless if it
+	is a single entity, list of entities or a page of entities.
+	"""
+	if isinstance(value, list):
+		return value
+	if '_items' in value and '_meta' in value:
+		return value['_items']
+	return [value]
+
+
+def _find_related(relation, values, projection):
+	"""Retrieves entities of the related resource referencing any of
+	the given values by a single query. Only fields requested by the
+	projection are read from the database.
+
+	Returns a dictionary mapping each value to the list of entities
+	referencing it. The entities are shared with the identity map of
+	the request and the embed cache and must not be modified.
+	"""
+	projection_key = _projection_key(projection)
+	# Generation is read before the query, so that entities changed
+	# meanwhile are cached under the generation preceding the change
+	generation = _generation(relation['resource'])
+	related = {}
+	if relation['fkey'] == 'id':
+		# Entities referenced by id may be already loaded by previous embedding
+		for value in list(values):
+			entity = _cached_entity(relation['resource'], value, projection_key)
+			if entity is not None:
+				related[value] = [entity]
+				values.discard(value)
+		if not values:
+			return related
+
+	# The number of entities embedded into one document may be limited
+	# to prevent unbounded responses
+	limit = config.EMBED_LIMIT
+	related_resource = current_app.data.driver.db[relation['resource']]
+	cursor = related_resource.find({relation['fkey']: {'$in': list(values)}}, _mongo_fields(projection))
+	if limit:
+		cursor = cursor.limit(limit * len(values) + 1)
+	results = list(cursor)
+	for result in results:
+		entity = _remember_entity(relation['resource'], result, projection_key)
+		# Only entities looked up by id are served from the embed cache
+		if relation['fkey'] == 'id':
+			embed_cache.set((config.URL_PREFIX, relation['resource'], entity['id'], projection_key, generation), entity)
+		related.setdefault(entity.get(relation['fkey']), []).append(entity)
+	if limit and (len(results) > limit * len(values) or any(len(r) > limit for r in related.values())):
+		abort(400, description=debug_error_message(
+			'Too many entities of relation `%s` to embed, use paged embedding' % relation['resource']))
+	return related
+
+
+def _identity_map():
+	"""Returns the identity map of the current request that holds
+	entities already retrieved from the database keyed by resource name,
+	entity id and projection. It ensures each related entity is read only once per
+	request even if it is embedded into many documents.
+	"""
+	if not hasattr(g, 'identity_map'):
+		g.identity_map = LRUCache(config.EMBED_IDENTITY_MAP_SIZE)
+	return g.identity_map
+
+
+# Entities embedded by previous requests shared by all parliaments of
+# the process, see `_cached_entity`.
+embed_cache = LRUCache(settings.common['EMBED_CACHE_SIZE'])
+
+
+def _cached_entity(resource, id, projection_key):
+	"""Returns entity of the resource with the given id and projection
+	retrieved from the database earlier or None if there is no such.
+
+	The entity is looked up in the identity map of the request first
+	and then in the embed cache shared across requests. Entries of the
+	embed cache are keyed by the current generation of the resource
+	that is changed on every write to the resource. Therefore entities
+	cached before a write are never returned after it, even if the
+	write was served by another process.
+	"""
+	identity_map = _identity_map()
+	entity = identity_map.get((resource, id, projection_key))
+	if entity is None:
+		entity = embed_cache.get((config.URL_PREFIX, resource, id, projection_key, _generation(resource)))
+		if entity is not None:
+			identity_map.set((resource, id, projection_key), entity)
+	return entity
+
+
+def _remember_entity(resource, entity, projection_key):
+	"""Stores the entity retrieved from the database into the identity
+	map of the request. Returns the entity from the identity map if it
+	has been already there.
+	"""
+	return _identity_map().setdefault((resource, entity['id'], projection_key), entity)
+
+
+def _generation(resource):
+	"""Returns the current generation of the resource. Generations of
+	all resources are read from the database once per request.
+	"""
+	if not hasattr(g, 'generations'):
+		g.generations = load_generations(current_app.data.driver.db)
+	return g.generations.get(resource, 0)
+
+
+def on_written_callback(resource, *args):
+	"""Changes generation of the resource after any write to it to
+	invalidate its entities in the embed cache.
+	"""
+	bump_generation(current_app.data.driver.db, resource)
+	if hasattr(g, 'generations'):
+		del g.generations
+
+
+# Rendered responses to GET requests shared by all parliaments of the process, see `before_request_callback`.
+response_cache = make_cache(settings.common['RESPONSE_CACHE'], settings.common['RESPONSE_CACHE_SIZE'],
+	settings.common['RESPONSE_CACHE_DIR'])
+
+# Headers of a response that are not cached because they differ among requests.
+_VOLATILE_HEADERS = ('Date', 'Expires', 'Content-Length', 'Access-Control-Allow-Origin',
+	'X-Identity-Map', 'X-Response-Cache')
+
+
+def before_request_callback():
+	"""Returns the cached response to a GET request if the same request
+	has been answered since the last change of the resources the response
+	depends on, see `after_request_callback`.
+
+	Cached responses are keyed by the generations of the resources, so a
+	write to a resource invalidates them (see `on_written_callback`).
+	A response with embedded entities depends on all resources.
+	"""
+	key = _response_cache_key()
+	if key is None: return
+	entry = response_cache.get(key)
+	if entry is None:
+		g.response_cache_key = key
+		return
+	status, headers, body = entry
+	resp = Response(body, status, headers)
+	resource = request.endpoint.split('|')[0]
+	expires = config.DOMAIN[resource]['cache_expires']
+	if expires:
+		resp.expires = time.time() + expires
+	origin = request.headers.get('Origin')
+	if origin and config.X_DOMAINS:
+		domains = [config.X_DOMAINS] if isinstance(config.X_DOMAINS, str) else config.X_DOMAINS
+		resp.headers['Access-Control-Allow-Origin'] = origin if '*' in domains or origin in domains else ''
+	resp.headers['X-Response-Cache'] = 'hit'
+	return resp.make_conditional(request)
+
+
+def _response_cache_key():
+	"""Returns the key of the response to the current request in the
+	response cache or None if the response is not to be cached.
+
+	The key consists of the URL with the query parameters normalized,
+	the media type of the response chosen by the `Accept` header, the
+	presence of the `Origin` header that adds CORS headers and the
+	generations of the resources the response depends on.
+	"""
+	if response_cache is None or request.method not in ('GET', 'HEAD'):
+		return None
+	if not request.endpoint or '|' not in request.endpoint:
+		return None
+	resource = request.endpoint.split('|')[0]
+	if resource not in config.DOMAIN:
+		return None
+	return (config.URL_PREFIX, request.path, _normalized_args(), _best_mime()[0],
+		'Origin' in request.headers, tuple(_generation(r) for r in _dependencies(resource)))
+
+
+def collection_etag_callback():
+	"""Answers a conditional GET request of a collection by `304 Not
+	Modified` without building the page if the version of the queried
+	documents has not changed, see `_collection_etag`. Otherwise the
+	version is sent as ETag of the response.
+	"""
+	if request.method not in ('GET', 'HEAD') or not request.endpoint or \
+			not request.endpoint.endswith('|resource'):
+		return
+	etag = _collection_etag(request.endpoint.split('|')[0])
+	if request.if_none_match.contains(etag):
+		resp = Response(status=304)
+		resp.set_etag(etag)
+		return resp
+	g.collection_etag = etag
+
+
+def _collection_etag(resource):
+	"""Returns ETag of the collection response to the current request.
+
+	In `exact` total mode the version of the documents matching the
+	`where` clause is their count and the latest `updated_at` among
+	them, which change by any insert, update or delete of a matching
+	document. The count is reused as the total of the page. Times of
+	updates are stored with a precision of seconds, so while the latest
+	update is recent, another one could have happened in the same second
+	and the generation of the resource is added.
+
+	In `cached` and `none` modes the client avoids counting, so the
+	generation of the resource is used instead.
+	"""
+	if pagination.total_mode(resource) != 'exact':
+		version = (_generation(resource), )
+	else:
+		req = parse_request(resource)
+		version = current_app.data.collection_version(resource, req, dict(request.view_args or {}))
+		latest = version[1]
+		if latest is not None and latest.replace(tzinfo=None) > datetime.utcnow() - timedelta(seconds=2):
+			version += (_generation(resource), )
+	embedded = tuple(_generation(r) for r in _dependencies(resource) if r != resource)
+	key = (config.URL_PREFIX, request.path, _normalized_args(), _best_mime()[0], version, embedded)
+	return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def _dependencies(resource):
+	"""Returns the resources the response of the current request to the
+	resource depends on. A response with embedded entities depends on
+	all resources.
+	"""
+	if 'embed' in request.args or 'embed_count' in request.args:
+		return sorted(config.DOMAIN)
+	return [resource]
+
+
+def _normalized_args():
+	"""Returns the URL query parameters of the current request sorted by
+	name, with the order of values of the same parameter kept.
+	"""
+	return tuple(sorted(((k, _normalized_arg(v)) for k, v in request.args.items(multi=True)), key=lambda a: a[0]))
+
+
+def _normalized_arg(value):
+	"""Returns the URL query parameter value with insignificant white
+	space removed from JSON values, e.g. `where` clauses.
+	"""
+	try:
+		return json.dumps(json.loads(value, object_pairs_hook=OrderedDict))
+	except ValueError:
+		return value
+
+
+def after_request_callback(response):
+	"""Adds the ETag of a collection, see `collection_etag_callback`, and
+	stores the response to the response cache, see `before_request_callback`.
+
+	Reports usage of the identity map in the response header to show
+	how many database lookups it saved.
+	"""
+	if hasattr(g, 'collection_etag'):
+		if response.status_code == 200 and 'ETag' not in response.headers:
+			response.set_etag(g.collection_etag)
+		del g.collection_etag
+	if hasattr(g, 'response_cache_key'):
+		key = g.response_cache_key
+		del g.response_cache_key
+		if request.method == 'GET' and response.status_code == 200 and not response.is_streamed:
+			body = response.get_data()
+			if len(body) <= config.RESPONSE_CACHE_MAX_ITEM_SIZE:
+				headers = [(k, v) for k, v in response.headers if k not in _VOLATILE_HEADERS]
+				response_cache.set(key, (response.status_code, headers, body))
+		response.headers['X-Response-Cache'] = 'miss'
+	if hasattr(g, 'identity_map'):
+		response.headers['X-Identity-Map'] = 'hits=%(hits)d, misses=%(misses)d, evictions=%(evictions)d' % \
+			g.identity_map.stats()
+	return response
+
+
+def _copy_document(document):
+	"""Returns a deep copy of the document retrieved from database.
+	Faster than `copy.deepcopy` because only dictionaries and lists
+	are copied while other values are immutable.
+	"""
+	if isinstance(document, dict):
+		return {k: _copy_document(v) for k, v in document.items()}
+	elif isinstance(document, list):
+		return [_copy_document(v) for v in document]
+	return document
 
 
 def on_insert_callback(resource, documents):
 	"""Creates default id-s (ObjectId as a string) in documents being inserted
-	not containing `id` field and mirrors remote files referenced
-	in the documents.
+	not containing `id` field and prepares mirroring of remote files
+	referenced in the documents.
 	"""
 	for doc in documents:
 		if 'id' not in doc:
 			doc['id'] = str(ObjectId())
 
 		# Download remote files referenced in the document and modify
-		# document fields to point to the local copy.
-		for field in config.DOMAIN[resource].get('save_files', []):
-			_relocate_url_field(resource, field, doc, {'id': doc['id']})
+		# document fields to point to the local copy later.
+		_prepare_mirroring(resource, doc, {'id': doc['id']})
 
 
 def on_update_callback(resource, updates, original):
-	"""Adds all changes in updated tracked properties to the list in
-	`changed` property of the resource.
+	"""Prepares all changes in updated tracked properties to be stored
+	in the history of the resource, see `on_changed_callback`.
+	Explicitly sent changes are stored in the history too.
 	"""
-	for field in config.DOMAIN[resource].get('save_files', []):
-		_relocate_url_field(resource, field, updates, original)
-
 	effective_date = request.args.get('effective_date') or date.today().isoformat()
-	if effective_date == 'fix': return
-
-	changes = []
-	for field in config.DOMAIN[resource].get('track_changes', []):
-		if field in updates and updates[field] != original.get(field):
-			change = _build_change(field, original, effective_date)
-			changes.append(change)
+	_prepare_mirroring(resource, updates, original, effective_date)
+
+	explicit_changes = updates.pop('changes', None)
+	if effective_date == 'fix':
+		# Explicitly sent changes replace the whole history on fix
+		if explicit_changes is not None:
+			g.pending_changes = (resource, original['id'], explicit_changes, True)
+			if 'changes' in original:
+				updates['changes'] = []
+		return
 
-	if changes or 'changes' in updates:
-		updates['changes'] = changes + updates.get('changes', []) + original.get('changes', [])
+	fields = [field for field in config.DOMAIN[resource].get('track_changes', [])
+		if field in updates and updates[field] != original.get(field)]
+	changes = history.build_changes(current_app.data.driver.db, resource, fields, original, effective_date)
+	g.pending_changes = (resource, original['id'], changes + (explicit_changes or []), False)
 
 
 def on_replace_callback(resource, document, original):
-	"""Adds all changes in all tracked properties to the list in
-	`changed` property of the resource.
+	"""Prepares all changes in all tracked properties to be stored in
+	the history of the resource, see `on_changed_callback`.
+	Explicitly sent changes are stored in the history too.
 	"""
-	for field in config.DOMAIN[resource].get('save_files', []):
-		_relocate_url_field(resource, field, document, original)
-
 	effective_date = request.args.get('effective_date') or date.today().isoformat()
-	if effective_date == 'fix': return
+	_prepare_mirroring(resource, document, original, effective_date)
 
-	changes = []
-	for field in config.DOMAIN[resource].get('track_changes', []):
-		if document.get(field) != original.get(field):
-			change = _build_change(field, original, effective_date)
-			changes.append(change)
-
-	if changes or 'changes' in document or 'changes' in original:
-		document['changes'] = changes + document.get('changes', []) + original.get('changes', [])
+	explicit_changes = document.pop('changes', None)
+	if effective_date == 'fix' and explicit_changes is not None:
+		# Explicitly sent changes replace the whole history on fix
+		g.pending_changes = (resource, original['id'], explicit_changes, True)
+		return
 
+	# Keep changes stored inside the entity before history was introduced
+	if 'changes' in original:
+		document['changes'] = original['changes']
+	if effective_date == 'fix': return
 
-def _relocate_url_field(resource, field, document, original):
-	"""Translates remote URL in the given field of the document to a
-	corresponding locally hosted file. Also if the field is newly added
-	or the remote file has changed, download it and store as a new
-	file.
+	fields = [field for field in config.DOMAIN[resource].get('track_changes', [])
+		if document.get(field) != original.get(field)]
+	changes = history.build_changes(current_app.data.driver.db, resource, fields, original, effective_date)
+	g.pending_changes = (resource, original['id'], changes + (explicit_changes or []), False)
 
-	If the remote URL does not exist, the field is left unchanged.
 
-	Implementation for `image` field in Slovak parliament (sk/nrsr) is
-	specific. Due to padded files it is impossible to detect changed
-	file by its changed length so the files are compared by content.
+def on_changed_callback(resource, *args):
+	"""Stores changes prepared by `on_update_callback` or
+	`on_replace_callback` into the history after the updated entity
+	has been written.
 	"""
-	if field not in document: return
-
-	# Get info about the URL target file.
-	try:
-		remote_url = document[field]
-		if config.URL_PREFIX == 'sk/nrsr' and field == 'image':
-			resp = requests.get(remote_url)
-		else:
-			resp = requests.head(remote_url, allow_redirects=True)
-		resp.raise_for_status()
-	except requests.exceptions.RequestException:
-		return
-
-	content_type = resp.headers['content-type']
-	_, ext = content_type.split('/')
-
-	# If the field is newly added or the remote file has changed, it must be downloaded.
-	pathfile = (config.FILES_DIR + '/' + config.URL_PREFIX + '/' +
-		resource + '/' + str(original['id']) + '/' + field)
-	if not original.get(field):
-		create_file = pathfile + '.' + ext
+	if not hasattr(g, 'pending_changes'): return
+	resource, id, changes, replace = g.pending_changes
+	del g.pending_changes
+	if replace:
+		history.replace_changes(current_app.data.driver.db, resource, id, changes)
 	else:
-		create_file = None
-		url = urllib.parse.unquote(original[field])
-		host = '%s://%s' % (config.FILES_PROTOCOL, config.FILES_HOST)
-		existing_file = url.replace(host, config.FILES_DIR, 1)
-
-		if not os.path.isfile(existing_file) or \
-				int(resp.headers['content-length']) != os.path.getsize(existing_file):
-			n = len(glob.glob(pathfile + '.*'))
-			create_file = pathfile + '.' + str(n+1) + '.' + ext
-
-		if config.URL_PREFIX == 'sk/nrsr' and field == 'image':
-			with open(existing_file, 'rb') as f:
-				existing_content = f.read()
-			if resp.content != existing_content:
-				n = len(glob.glob(pathfile + '.*'))
-				create_file = pathfile + '.' + str(n+1) + '.' + ext
-
-	# Download and store the remote file.
-	if create_file:
-		if not (config.URL_PREFIX == 'sk/nrsr' and field == 'image'):
-			resp = requests.get(remote_url)
-			resp.raise_for_status()
-		os.makedirs(os.path.dirname(create_file), exist_ok=True)
-		with open(create_file, 'wb') as f:
-			f.write(resp.content)
-
-	# Modify the field in the document to contain the local file.
-	if create_file:
-		url = create_file.replace(config.FILES_DIR, config.FILES_HOST, 1)
-		url = urllib.parse.quote(url)
-		document[field] = '%s://%s' % (config.FILES_PROTOCOL, url)
-	else:
-		document[field] = original[field]
+		history.add_changes(current_app.data.driver.db, resource, id, changes)
+
 
+def _prepare_mirroring(resource, document, original, effective_date=None):
+	"""Prepares mirroring of remote files referenced in the fields of
+	the document listed in `save_files` of the resource. The files are
+	downloaded by background workers after the document is stored, see
+	`on_mirroring_callback` and `mirroring.mirror_file`.
 
-def _build_change(field, original, effective_date):
-	"""Creates a change holding original value of the field to include
-	into the list of changes.
+	Until the local copy of the file exists, the field keeps its former
+	value or the remote URL if there is no former value.
 	"""
-	change = {
-		'property': field,
-		'value': original.get(field),
-		'end_date': _datestring_add(effective_date, -1),
+	for field in config.DOMAIN[resource].get('save_files', []):
+		if field not in document: continue
+		job = {
+			'resource': resource,
+			'id': original['id'],
+			'field': field,
+			'url': document[field],
+			'effective_date': effective_date,
+			'track': effective_date not in (None, 'fix') and field in config.DOMAIN[resource].get('track_changes', []),
+		}
+		if original.get(field):
+			document[field] = original[field]
+		if not hasattr(g, 'pending_mirroring'):
+			g.pending_mirroring = []
+		g.pending_mirroring.append(job)
+
+
+def on_mirroring_callback(resource, *args):
+	"""Submits mirroring of files prepared by `_prepare_mirroring` to
+	the background workers after the documents have been written.
+	"""
+	if not hasattr(g, 'pending_mirroring'): return
+	jobs = g.pending_mirroring
+	del g.pending_mirroring
+	job_config = {key: current_app.config[key] for key in ('URL_PREFIX', 'FILES_DIR', 'FILES_HOST',
+		'FILES_PROTOCOL', 'LAST_UPDATED', 'ETAG', 'MIRROR_HOST_CONCURRENCY', 'MIRROR_RETRIES',
+		'MIRROR_RETRY_DELAY', 'MIRROR_TIMEOUT', 'MIRROR_CONTENT_COMPARE')}
+	pool = _worker_pool()
+	for job in jobs:
+		job['db'] = current_app.data.driver.db
+		job['config'] = job_config
+		# Mirroring of files of the same entity is serialized to keep the versions of files in order
+		pool.submit((config.URL_PREFIX, job['resource'], job['id']), mirror_file, job)
+
+
+def on_log_written_callback(resource, *args):
+	"""Submits rebuilding of the snapshot of the parliament to the
+	background workers when a scraper run is recorded as finished in
+	`logs`, see `snapshots.build_snapshot`.
+	"""
+	if resource != 'logs': return
+	documents = args[0] if isinstance(args[0], list) else [args[0]]
+	finished = [doc for doc in documents if doc.get('status') == 'finished']
+	if not finished: return
+	# The original document of an update contains the id of the log
+	log = args[1] if len(args) > 1 else finished[-1]
+	# Logs of scraper runs are internal and not included in snapshots
+	resources = sorted(r for r in config.DOMAIN if r != 'logs')
+	job = {
+		'db': current_app.data.driver.db,
+		'resources': resources,
+		'tracked': [r for r in resources if config.DOMAIN[r].get('track_changes')],
+		'log_id': log['id'],
+		'config': {key: current_app.config[key] for key in
+			('URL_PREFIX', 'FILES_DIR', 'LAST_UPDATED', 'DATE_FORMAT', 'ETAG', 'SNAPSHOT_TIMEOUT')},
 	}
-	# If there are older values of this property already present in `changes`,
-	# then validity of the current value will start immediately after the most
-	# recent one.
-	former_end_dates = [ch['end_date']
-		for ch in original.get('changes', [])
-		if ch['property'] == field]
-	if former_end_dates:
-		change['start_date'] = _datestring_add(max(former_end_dates), 1)
+	# Snapshots of the same parliament are built one after another
+	_worker_pool().submit((config.URL_PREFIX, 'snapshot'), build_snapshot, job)
 
-	return change
 
+# Background workers shared by all parliaments of the process, see `_worker_pool`.
+worker_pool = None
+_worker_pool_lock = threading.Lock()
 
-def _datestring_add(datestring, days):
-	"""Returns the date specified as string in ISO format with given
-	number of days added.
+def _worker_pool():
+	"""Returns the pool of background workers, creating it on the first
+	use.
 	"""
-	return (datetime.strptime(datestring, '%Y-%m-%d') + timedelta(days=days)).date().isoformat()
+	global worker_pool
+	with _worker_pool_lock:
+		if worker_pool is None:
+			worker_pool = WorkerPool(config.WORKERS, config.WORKER_QUEUE_SIZE)
+		return worker_pool
 
 
 def on_delete_item_callback(resource, document):
-	"""Deletes downloaded and stored files related to the entity
-	about to be deleted.
+	"""Deletes downloaded and stored files and history related to the
+	entity about to be deleted.
 	"""
 	path = (config.FILES_DIR + '/' + config.URL_PREFIX + '/' +
 		resource + '/' + str(document['id']))
-	shutil.rmtree(path, ignore_errors=True)
+	filestore.remove_files(config.FILES_DIR, path)
+	history.delete_changes(current_app.data.driver.db, resource, document['id'])
 
 
 def on_delete_resource_callback(resource):
-	"""Deletes all downloaded and stored files related to the resource.
+	"""Deletes all downloaded and stored files and history related to
+	the resource.
 	"""
 	path = (config.FILES_DIR + '/' + config.URL_PREFIX + '/' + resource)
-	shutil.rmtree(path, ignore_errors=True)
+	filestore.remove_files(config.FILES_DIR, path)
+	history.delete_changes(current_app.data.driver.db, resource)
+
+
+def on_pre_post_callback(resource, request):
+	"""Prefetches data needed to validate `unique`, `disjoint` and
+	`data_relation` rules for all documents of a bulk insert at once.
+
+	Instead of one query per document and field (or even per list
+	element for `disjoint`), values of each field in all documents are
+	checked against the database by a single query. Referenced values
+	of all fields with `data_relation` to the same resource are checked
+	by a single query too. The results are stored for the request and
+	used by `VpapiValidator` which also detects clashes between
+	documents of the bulk insert.
+	"""
+	payload = request.get_json(silent=True)
+	if not isinstance(payload, list): return
+	documents = [doc for doc in payload if isinstance(doc, dict)]
+	db = current_app.data.driver.db
+	g.prefetched = {}
+	references = {}
+
+	for field, rules in config.DOMAIN[resource]['schema'].items():
+		relation = rules.get('data_relation')
+		if relation and not relation.get('version'):
+			values = references.setdefault((relation['resource'], relation['field']), set())
+			for doc in documents:
+				for value in doc.get(field) if isinstance(doc.get(field), list) else [doc.get(field)]:
+					if value is not None and _hashable(value):
+						values.add(value)
+
+		if rules.get('unique'):
+			values = set()
+			for doc in documents:
+				if field in doc and _hashable(doc[field]):
+					values.add(doc[field])
+			if values:
+				results = db[resource].find({field: {'$in': list(values)}}, {'_id': False, field: True})
+				existing = set(result[field] for result in results if _hashable(result.get(field)))
+				g.prefetched[('unique', resource, field)] = {'checked': values, 'existing': existing, 'seen': set()}
+
+		if rules.get('disjoint'):
+			elements = {}
+			for doc in documents:
+				if not isinstance(doc.get(field), list): continue
+				for element in doc[field]:
+					key = _element_key(element)
+					if key is not None:
+						elements[key] = element
+			if elements:
+				g.prefetched[('disjoint', resource, field)] = {
+					'checked': set(elements),
+					'existing': _find_common_elements(db[resource], field, elements),
+					'seen': set(),
+				}
+
+	for (related_resource, related_field), values in references.items():
+		if not values: continue
+		results = db[related_resource].find({related_field: {'$in': list(values)}}, {'_id': False, related_field: True})
+		existing = set(result[related_field] for result in results if _hashable(result.get(related_field)))
+		g.prefetched[('data_relation', related_resource, related_field)] = {'checked': values, 'existing': existing}
+
+
+def _find_common_elements(collection, field, elements):
+	"""Returns keys of the given list elements (see `_element_key`) that
+	are contained in the list field of any existing document. All
+	elements are looked up by a single query.
+
+	A dictionary element is contained in the list if the list contains
+	a dictionary with all the items of the element, as `$elemMatch`
+	operator does.
+	"""
+	dicts = {key: element for key, element in elements.items() if isinstance(element, dict)}
+	others = [element for element in elements.values() if not isinstance(element, dict)]
+	query = [{field: {'$elemMatch': element}} for element in dicts.values()]
+	if others:
+		query.append({field: {'$in': others}})
+
+	# Index dictionary elements by one of their items to match them quickly
+	by_item = {}
+	for key, element in dicts.items():
+		by_item.setdefault(min(element.items()), []).append(key)
+
+	found = set()
+	for result in collection.find({'$or': query}, {'_id': False, field: True}):
+		for existing in result.get(field, []):
+			if isinstance(existing, dict):
+				for item in existing.items():
+					if not _hashable(item): continue
+					for key in by_item.get(item, []):
+						if all(existing.get(k) == v for k, v in key):
+							found.add(key)
+			elif _hashable(existing) and existing in elements:
+				found.add(existing)
+	return found
+
+
+def _element_key(element):
+	"""Returns a hashable key identifying the list element or None if
+	the element cannot be identified this way.
+	"""
+	if isinstance(element, dict):
+		key = frozenset(element.items())
+		return key if element and _hashable(key) else None
+	return element if _hashable(element) else None
+
+
+def _hashable(value):
+	"""Returns True if the value can be used as a key in dictionary."""
+	try:
+		hash(value)
+	except TypeError:
+		return False
+	return True
+
+
+def _prefetched(rule, resource, field, keys):
+	"""Returns data prefetched by `on_pre_post_callback` to validate the
+	rule for the given field if they cover all the given keys,
+	otherwise None.
+	"""
+	prefetched = getattr(g, 'prefetched', {}).get((rule, resource, field))
+	if prefetched is None or not all(_hashable(key) and key in prefetched['checked'] for key in keys):
+		return None
+	return prefetched
+
+
+# Regular expressions of values of the custom rule `format`.
+FORMATS = {
+	'partialdate': re.compile(r'^[0-9]{4}(-[0-9]{2}){0,2}$'),
+	'partialdatetime': re.compile(r'^[0-9]{4}((-[0-9]{2}){0,2}|(-[0-9]{2}){2}(T[0-9]{2}(:[0-9]{2}(:[0-9]{2})?)?Z)?)$'),
+	'email': re.compile(r'[^@]+@[^@]+\.[^@]+'),
+	'url': None,
+}
 
 
 class VpapiValidator(Validator):
 	"""Additional validations in the schema.
 	"""
+	def _validate(self, document, schema=None, update=False, context=None):
+		"""Validates documents of bulk inserts by the schema of the
+		resource compiled at the app creation, see `schema_compiler`.
+		Other documents are validated by Cerberus.
+		"""
+		compiled = None
+		if self.resource and schema is None and context is None and isinstance(document, dict) \
+				and getattr(g, 'prefetched', None) is not None:
+			compiled = current_app.compiled_schemas.get(self.resource)
+		if compiled is None:
+			return super()._validate(document, schema, update, context)
+		self.update = update
+		self.document = document
+		return compiled(self, document, update)
+
+	def _validate_unique(self, unique, field, value):
+		"""Validates `unique` rule using values prefetched for bulk
+		inserts if available. Detects also duplicate values within the
+		bulk insert.
+		"""
+		if unique and not self._id:
+			prefetched = _prefetched('unique', self.resource, field, [value])
+			if prefetched is not None:
+				if value in prefetched['existing'] or value in prefetched['seen']:
+					self._error(field, "value '%s' is not unique" % value)
+				prefetched['seen'].add(value)
+				return
+		super()._validate_unique(unique, field, value)
+
+	def _validate_data_relation(self, data_relation, field, value):
+		"""Validates `data_relation` rule using referenced values
+		prefetched for bulk inserts if available.
+		"""
+		if not data_relation.get('version'):
+			items = value if isinstance(value, list) else [value]
+			prefetched = _prefetched('data_relation', data_relation['resource'], data_relation['field'], items)
+			if prefetched is not None:
+				for item in items:
+					if item not in prefetched['existing']:
+						self._error(field,
+							"value '%s' must exist in resource '%s', field '%s'." %
+							(item, data_relation['resource'], data_relation['field']))
+				return
+		super()._validate_data_relation(data_relation, field, value)
+
 	def _validate_format(self, format, field, value):
 		"""Validates custom rule `format`.
 
 		No validation is performed for URLs because virtually
 		everything is a valid URL according to RFC 3986.
 		"""
-		if format not in ['partialdate', 'partialdatetime', 'email', 'url']:
+		if format not in FORMATS:
 			self._error(field, 'Unknown format "{0}"'.format(format))
-
-		partialdate_regex = r'^[0-9]{4}(-[0-9]{2}){0,2}$'
-		partialdatetime_regex = r'^[0-9]{4}((-[0-9]{2}){0,2}|(-[0-9]{2}){2}(T[0-9]{2}(:[0-9]{2}(:[0-9]{2})?)?Z)?)$'
-		email_regex = r'[^@]+@[^@]+\.[^@]+'
-
-		if format == 'partialdate' and not re.match(partialdate_regex, value) or \
-				format == 'partialdatetime' and not re.match(partialdatetime_regex, value) or \
-				format == 'email' and not re.match(email_regex, value):
+		elif FORMATS[format] and not FORMATS[format].match(value):
 			self._error(field, "Value '{0}' does not satisfy format '{1}'".format(value, format))
 
 	def _validate_disjoint(self, disjoint, field, value):
@@ -321,6 +1090,18 @@ class VpapiValidator(Validator):
 		"""
 		if not isinstance(value, list):
 			self._error(field, '`disjoint` rule allowed only for `list` fields')
+			return
+		if disjoint and not self._id:
+			# Use elements prefetched for bulk inserts if available
+			keys = [_element_key(element) for element in value]
+			prefetched = _prefetched('disjoint', self.resource, field, keys)
+			if prefetched is not None:
+				if any(key in prefetched['existing'] or key in prefetched['seen'] for key in keys):
+					self._error(field,
+						'value `%s` for field `%s` contains a common element with an existing value' %
+						(value, field))
+				prefetched['seen'].update(keys)
+				return
 		if disjoint:
 			query = {}
 			if self._id:
@@ -355,6 +1136,77 @@ class VpapiValidator(Validator):
 					value)
 
 
+# Totals of documents matching queries shared by all parliaments of the
+# process, see `pagination.PageCursor`.
+totals_cache = LRUCache(settings.common['TOTALS_CACHE_SIZE'])
+
+
+class VpapiMongo(Mongo):
+	"""Mongo data layer supporting keyset pagination requested by the
+	`after` URL query parameter and optional or cached totals requested
+	by the `total` parameter, see `pagination`.
+	"""
+	def find(self, resource, req, sub_resource_lookup):
+		total = pagination.total_mode(resource)
+		key = None
+		if total == 'cached':
+			key = pagination.count_key(resource, req, sub_resource_lookup) + (_generation(resource), )
+		if pagination.CURSOR_PARAM not in request.args:
+			cursor = super().find(resource, req, sub_resource_lookup)
+			page_cursor = pagination.PageCursor(cursor, req, total, totals_cache, key)
+			page_cursor.counted = self._counted(resource, req, sub_resource_lookup)
+			return page_cursor
+
+		if req.page > 1:
+			abort(400, description=debug_error_message(
+				'`page` cannot be combined with `%s`' % pagination.CURSOR_PARAM))
+		# The total counts all documents of the query, not only those after the cursor
+		count_cursor = super().find(resource, req, sub_resource_lookup)
+		sort = pagination.keyset_sort(resource, req.sort)
+		lookup = dict(sub_resource_lookup or {})
+		cursor = request.args[pagination.CURSOR_PARAM]
+		if cursor:
+			lookup.update(pagination.keyset_query(sort, cursor))
+		req = copy.copy(req)
+		req.sort = repr(sort)
+		req.projection, hidden_fields = pagination.projection_with_sort(req.projection, sort)
+		cursor = super().find(resource, req, lookup)
+		page_cursor = pagination.KeysetCursor(cursor, req, total, totals_cache, key, count_cursor, sort, hidden_fields)
+		page_cursor.counted = self._counted(resource, req, sub_resource_lookup)
+		return page_cursor
+
+	@staticmethod
+	def _counted(resource, req, sub_resource_lookup):
+		"""Returns the number of documents matching the query of the
+		request if already counted by `collection_version`, or None.
+		"""
+		counted = getattr(g, 'collection_count', None)
+		if counted and counted[0] == pagination.count_key(resource, req, sub_resource_lookup):
+			return counted[1]
+		return None
+
+	def collection_version(self, resource, req, sub_resource_lookup):
+		"""Returns the number of documents matching the query of the
+		request and the latest `updated_at` among them. The count is
+		remembered for the page of the request, see `_counted`.
+		"""
+		req = copy.copy(req)
+		req.sort = None
+		req.page = 1
+		req.max_results = 1
+		req.projection = None
+		cursor = super().find(resource, req, sub_resource_lookup)
+		latest = list(cursor.clone().sort(config.LAST_UPDATED, -1).limit(1))
+		count = cursor.count()
+		g.collection_count = (pagination.count_key(resource, req, sub_resource_lookup), count)
+		return count, latest[0].get(config.LAST_UPDATED) if latest else None
+
+
+class VpapiTenantMongo(TenantMongo, VpapiMongo):
+	"""Data layer of the multi-tenant application."""
+	pass
+
+
 class VpapiBasicAuth(BasicAuth):
 	"""Authentication used for write access to the API."""
 	def check_auth(self, username, password, allowed_roles, resource, method):
@@ -362,36 +1214,92 @@ class VpapiBasicAuth(BasicAuth):
 
 
 def create_app(country_code, parliament):
-	# Merge parliament specific settings on top of common settings.
-	instance_settings = settings.common
-	instance_settings.update({
-		'URL_PREFIX': country_code + '/' + parliament['code'],
-		'MONGO_DBNAME': country_code + '_' + parliament['code'].replace('-', '_'),
-		'AUTHORIZED_USERS': parliament['authorized_users'],
-	})
+	# Merge parliament specific settings on top of a copy of common settings.
+	instance_settings = dict(settings.common)
+	instance_settings.update(tenant_settings(country_code, parliament))
 
 	app = Eve(
 		settings=instance_settings,
 		validator=VpapiValidator,
+		data=VpapiMongo,
 		auth=VpapiBasicAuth
 	)
+	init_app(app)
+	return app
+
+
+def create_multi_tenant_app(parliaments):
+	"""Creates a single application serving all the given parliaments
+	(a dictionary of lists of parliaments by country code), see `tenants`.
+	"""
+	tenants = {}
+	for country_code, country_parliaments in parliaments.items():
+		for parliament in country_parliaments:
+			tenant = tenant_settings(country_code, parliament)
+			tenants[tenant['URL_PREFIX']] = tenant
+
+	instance_settings = dict(settings.common)
+	instance_settings['URL_PREFIX'] = URL_PREFIX_PATTERN
+	app = TenantEve(
+		tenants,
+		settings=instance_settings,
+		validator=VpapiValidator,
+		data=VpapiTenantMongo,
+		auth=VpapiBasicAuth
+	)
+	init_app(app)
+	return app
+
+
+def init_app(app):
+	"""Registers the API callbacks to the application."""
+	app.compiled_schemas = schema_compiler.compile_domain(app.config['DOMAIN'], FORMATS)
+
+	# Fast rendering of JSON responses, see FAST_JSON setting.
+	renderers.install()
 
 	# Removing of _id-s and embedding of related entities.
 	app.on_fetched_item += on_fetched_item_callback
 	app.on_fetched_resource += on_fetched_resource_callback
+	app.after_request(after_request_callback)
+
+	# Serving of cached responses and conditional requests of collections.
+	app.before_request(before_request_callback)
+	app.before_request(collection_etag_callback)
+
+	# Streamed export of whole resources.
+	app.add_url_rule(app.api_prefix + '/export/<resource>', 'export', export.export_resource)
+
+	# Validation of all documents of bulk inserts at once.
+	app.on_pre_POST += on_pre_post_callback
 
 	# Creation of missing id-s and mirroring of referenced files.
 	app.on_insert += on_insert_callback
+	app.on_inserted += on_mirroring_callback
+	app.on_updated += on_mirroring_callback
+	app.on_replaced += on_mirroring_callback
 
 	# Tracking of changed values on update and replace.
 	app.on_update += on_update_callback
 	app.on_replace += on_replace_callback
+	app.on_updated += on_changed_callback
+	app.on_replaced += on_changed_callback
 
-	# Removing of mirrored files related to deleted entities.
+	# Removing of mirrored files and history related to deleted entities.
 	app.on_delete_item += on_delete_item_callback
 	app.on_delete_resource += on_delete_resource_callback
 
-	return app
+	# Invalidation of cached entities after the changes are written.
+	app.on_inserted += on_written_callback
+	app.on_updated += on_written_callback
+	app.on_replaced += on_written_callback
+	app.on_deleted_item += on_written_callback
+	app.on_deleted_resource += on_written_callback
+
+	# Rebuilding of snapshots after finished scraper runs.
+	app.on_inserted += on_log_written_callback
+	app.on_updated += on_log_written_callback
+	app.on_replaced += on_log_written_callback
 
 
 # A special application serving HATEOAS links to available countries and parliaments.
@@ -400,42 +1308,78 @@ cors = CORS(hateoas_app)
 
 @hateoas_app.route('/')
 def country_list():
-	with open(os.path.join(os.path.dirname(__file__), 'conf', 'countries.json'), 'r') as f:
-		countries = json.load(f)
-	if 'application/xml' in request.headers['accept']:
-		resp = '<resource>'
-		for country in countries:
-			resp += '<link rel="child" href="%s" title="%s" locale="%s" timezone="%s"/>' % (
-				country['code'], country['name'], country['locale'], country['timezone'])
-		resp += '</resource>'
-		return Response(response=resp, mimetype='application/xml')
-	else:
-		resp = {'_links': {'child': []}}
-		for country in countries:
-			resp['_links']['child'].append({
-				'title': country['name'],
-				'href': country['code'],
-				'locale': country['locale'],
-				'timezone': country['timezone'],
-			})
-		return jsonify(**resp)
+	return _hateoas_response(_hateoas_config('countries.json', _render_countries))
 
 
 @hateoas_app.route('/<country>/')
 def parliament_list(country):
-	with open(os.path.join(os.path.dirname(__file__), 'conf', 'parliaments.json'), 'r') as f:
-		parliaments = json.load(f)
-	if 'application/xml' in request.headers['accept']:
-		resp = '<resource>'
-		for parl in parliaments[country]:
-			resp += '<link rel="child" href="%s" title="%s"/>' % (parl['code'], parl['name'])
-		resp += '</resource>'
-		return Response(response=resp, mimetype='application/xml')
-	else:
-		resp = {'_links': {'child': []}}
-		for parl in parliaments[country]:
-			resp['_links']['child'].append({'title': parl['name'], 'href': parl['code']})
-		return jsonify(**resp)
+	representations = _hateoas_config('parliaments.json', _render_parliaments).get(country)
+	if representations is None:
+		abort(404)
+	return _hateoas_response(representations)
+
+
+# Pre-rendered responses of HATEOAS application by configuration file name.
+_hateoas_cache = {}
+
+def _hateoas_config(file_name, render):
+	"""Returns responses pre-rendered by `render` from the configuration
+	file. The file is loaded again only if its modification time has
+	changed.
+	"""
+	path = os.path.join(os.path.dirname(__file__), 'conf', file_name)
+	mtime = os.stat(path).st_mtime
+	cached = _hateoas_cache.get(file_name)
+	if cached is None or cached[0] != mtime:
+		with open(path, 'r') as f:
+			cached = (mtime, render(json.load(f)))
+		_hateoas_cache[file_name] = cached
+	return cached[1]
+
+
+def _render_countries(countries):
+	return _render_links([
+		[('href', c['code']), ('title', c['name']), ('locale', c['locale']), ('timezone', c['timezone'])]
+		for c in countries])
+
+
+def _render_parliaments(parliaments):
+	return {
+		country: _render_links([[('href', p['code']), ('title', p['name'])] for p in parls])
+		for country, parls in parliaments.items()
+	}
+
+
+def _render_links(links):
+	"""Returns JSON and XML representations of the list of child links,
+	each given as a list of (attribute, value) pairs, as a dictionary
+	mapping mimetypes to pairs (body, ETag).
+	"""
+	bodies = {
+		'application/json': json.dumps({'_links': {'child': [dict(link) for link in links]}},
+			indent=2, sort_keys=True),
+		'application/xml': '<resource>' + ''.join(
+			'<link rel="child" %s/>' % ' '.join('%s="%s"' % (attr, xml_escape(value, {'"': '&quot;'}))
+				for attr, value in link)
+			for link in links) + '</resource>',
+	}
+	representations = {}
+	for mimetype, body in bodies.items():
+		body = body.encode('utf-8')
+		representations[mimetype] = (body, hashlib.sha1(body).hexdigest())
+	return representations
+
+
+def _hateoas_response(representations):
+	"""Returns the representation requested by the Accept header with a
+	strong ETag, or `304 Not Modified` if the client has it already.
+	"""
+	mimetype = 'application/xml' if 'application/xml' in request.headers.get('accept', '') else 'application/json'
+	body, etag = representations[mimetype]
+	resp = Response(response=body, mimetype=mimetype)
+	resp.set_etag(etag)
+	resp.headers['Vary'] = 'Accept'
+	return resp.make_conditional(request)
 
 
 # If executed directly by built-in application server, use example parliament xx/example.
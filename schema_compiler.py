@@ -0,0 +1,272 @@
+"""Compiler of resource schemas into validation functions.
+
+Cerberus validator interprets the schema for every validated document,
+creates a new validator (validating its schema again) for each element
+of a list of subdocuments and looks up the validation methods by name
+for each field. A compiled schema is a tree of closures prepared once,
+with regular expressions of formats precompiled, that validates the
+document with the same result and error messages as Cerberus 0.8.
+
+Rules not implemented here are delegated to the respective `_validate_*`
+methods of the validator at the top level of the document. Schemas that
+cannot be compiled (e.g. they use such rules in subdocuments) are left
+for Cerberus to validate.
+"""
+
+from collections.abc import Mapping, Sequence
+from datetime import datetime
+
+# Error messages of Cerberus.
+ERROR_UNKNOWN_FIELD = "unknown field"
+ERROR_REQUIRED_FIELD = "required field"
+ERROR_BAD_TYPE = "must be of %s type"
+ERROR_UNALLOWED_VALUES = "unallowed values %s"
+ERROR_UNALLOWED_VALUE = "unallowed value %s"
+ERROR_EMPTY_NOT_ALLOWED = "empty values not allowed"
+ERROR_NOT_NULLABLE = "null value not allowed"
+
+# Rules handled by Cerberus before the other ones.
+SPECIAL_RULES = ('required', 'nullable', 'type', 'dependencies', 'readonly')
+
+# Rules that do not depend on the resource or the validated document and
+# thus can be delegated to the validator even inside of subdocuments.
+CONTEXT_FREE_RULES = ('unique_elements', )
+
+
+class SchemaNotCompilable(Exception):
+	"""Raised if the schema contains a rule that cannot be compiled."""
+	pass
+
+
+def compile_domain(domain, formats):
+	"""Returns a dictionary mapping resource names to the compiled
+	schemas of the resources. Resources with schemas that cannot be
+	compiled are omitted.
+
+	:param domain: the `DOMAIN` settings
+	:param formats: dictionary mapping names of formats of the `format`
+		rule to compiled regular expressions (or None if any value
+		satisfies the format)
+	"""
+	compiled = {}
+	for resource, settings in domain.items():
+		try:
+			compiled[resource] = compile_schema(settings['schema'], formats,
+				settings.get('allow_unknown', False))
+		except SchemaNotCompilable:
+			pass
+	return compiled
+
+
+def compile_schema(schema, formats, allow_unknown=False):
+	"""Compiles the schema into a function `validate(validator, document,
+	update)` that validates the document and stores errors into
+	`validator._errors` the same way as `validator.validate(document,
+	update=update)` of Cerberus does.
+	"""
+	validate_document = _compile_document(schema, formats, allow_unknown, top_level=True)
+
+	def validate(validator, document, update=False):
+		validator._errors = {}
+		validate_document(validator, validator._errors, document, update)
+		return len(validator._errors) == 0
+
+	return validate
+
+
+def _compile_document(schema, formats, allow_unknown, top_level=False):
+	"""Returns a function `validate(validator, errors, document, update)`
+	validating the (sub)document against the schema and storing errors
+	into the `errors` dictionary.
+	"""
+	if allow_unknown not in (True, False):
+		raise SchemaNotCompilable('allow_unknown schema')
+	checks = {field: _compile_field(definition, formats, allow_unknown, top_level)
+		for field, definition in schema.items()}
+	required = [field for field, definition in schema.items() if definition.get('required') is True]
+
+	def validate(validator, errors, document, update):
+		for field, value in document.items():
+			check = checks.get(field)
+			if check is not None:
+				check(validator, errors, field, value, update)
+			elif not allow_unknown:
+				_error(errors, field, ERROR_UNKNOWN_FIELD)
+		if not update:
+			for field in required:
+				if field not in document:
+					_error(errors, field, ERROR_REQUIRED_FIELD)
+
+	return validate
+
+
+def _compile_field(definition, formats, allow_unknown, top_level):
+	"""Returns a function `check(validator, errors, field, value, update)`
+	validating the value of a field against its definition.
+	"""
+	if 'dependencies' in definition or 'readonly' in definition:
+		raise SchemaNotCompilable('unsupported rule')
+	nullable = definition.get('nullable', False) is True
+	type_check = _compile_type(definition['type']) if 'type' in definition else None
+	rules = []
+	for rule, constraint in definition.items():
+		if rule in SPECIAL_RULES:
+			continue
+		elif rule == 'empty':
+			rules.append(_compile_empty(constraint))
+		elif rule == 'allowed':
+			rules.append(_compile_allowed(constraint))
+		elif rule == 'format':
+			rules.append(_compile_format(constraint, formats))
+		elif rule == 'schema':
+			rules.append(_compile_subschema(constraint, definition.get('type'), formats, allow_unknown))
+		elif top_level or rule in CONTEXT_FREE_RULES:
+			rules.append(_delegate(rule, constraint, top_level))
+		else:
+			raise SchemaNotCompilable('unsupported rule %s' % rule)
+
+	def check(validator, errors, field, value, update):
+		if value is None:
+			if nullable:
+				return
+			_error(errors, field, ERROR_NOT_NULLABLE)
+		if type_check is not None:
+			error = type_check(value)
+			if error:
+				_error(errors, field, error)
+			if errors.get(field):
+				return
+		for rule in rules:
+			rule(validator, errors, field, value, update)
+
+	return check
+
+
+def _compile_type(data_type):
+	"""Returns a function returning an error message if the value is
+	not of the given type, otherwise None.
+	"""
+	error = ERROR_BAD_TYPE % data_type
+	checks = {
+		'string': lambda value: isinstance(value, str),
+		'integer': lambda value: isinstance(value, int),
+		'float': lambda value: isinstance(value, (float, int)),
+		'number': lambda value: isinstance(value, (float, int)),
+		'boolean': lambda value: isinstance(value, bool),
+		'datetime': lambda value: isinstance(value, datetime),
+		'dict': lambda value: isinstance(value, Mapping),
+		'list': lambda value: isinstance(value, Sequence) and not isinstance(value, str),
+	}
+	if data_type not in checks:
+		raise SchemaNotCompilable('unsupported type %s' % data_type)
+	is_valid = checks[data_type]
+	return lambda value: None if is_valid(value) else error
+
+
+def _compile_empty(empty):
+	def check(validator, errors, field, value, update):
+		if isinstance(value, str) and len(value) == 0 and not empty:
+			_error(errors, field, ERROR_EMPTY_NOT_ALLOWED)
+	return check
+
+
+def _compile_allowed(allowed):
+	allowed_set = set(allowed)
+
+	def check(validator, errors, field, value, update):
+		if isinstance(value, str):
+			if value not in allowed:
+				_error(errors, field, ERROR_UNALLOWED_VALUE % value)
+		elif isinstance(value, Sequence):
+			disallowed = set(value) - allowed_set
+			if disallowed:
+				_error(errors, field, ERROR_UNALLOWED_VALUES % list(disallowed))
+		elif isinstance(value, int):
+			if value not in allowed:
+				_error(errors, field, ERROR_UNALLOWED_VALUE % value)
+	return check
+
+
+def _compile_format(format, formats):
+	"""Compiles custom rule `format`, see `VpapiValidator._validate_format`."""
+	if format not in formats:
+		def check(validator, errors, field, value, update):
+			_error(errors, field, 'Unknown format "{0}"'.format(format))
+		return check
+	regex = formats[format]
+	if regex is None:
+		return lambda validator, errors, field, value, update: None
+
+	def check(validator, errors, field, value, update):
+		if not regex.match(value):
+			_error(errors, field, "Value '{0}' does not satisfy format '{1}'".format(value, format))
+	return check
+
+
+def _compile_subschema(schema, data_type, formats, allow_unknown):
+	"""Compiles rule `schema` for a subdocument or a list of items.
+
+	The type of the field must be declared so that the value reaching
+	the rule is known to be a dict or a list.
+	"""
+	if data_type == 'list':
+		item_check = _compile_field(schema, formats, allow_unknown, False)
+
+		def check(validator, errors, field, value, update):
+			# Items are validated like documents {i: item} never in update mode
+			list_errors = {}
+			for i in range(len(value)):
+				item_check(validator, list_errors, i, value[i], False)
+			if list_errors:
+				_error(errors, field, list_errors)
+		return check
+
+	if data_type != 'dict':
+		raise SchemaNotCompilable('schema rule of a field of type %s' % data_type)
+	validate_subdocument = _compile_document(schema, formats, allow_unknown)
+
+	def check(validator, errors, field, value, update):
+		subdocument_errors = {}
+		validate_subdocument(validator, subdocument_errors, value, update)
+		if subdocument_errors:
+			_error(errors, field, subdocument_errors)
+	return check
+
+
+def _delegate(rule, constraint, top_level):
+	"""Returns a function validating the rule by the respective method
+	of the validator.
+	"""
+	method_name = '_validate_' + rule.replace(' ', '_')
+
+	def check(validator, errors, field, value, update):
+		method = getattr(validator, method_name, None)
+		if method is None:
+			return
+		if top_level:
+			method(constraint, field, value)
+			return
+		# Let the method report errors into the errors of the subdocument
+		saved_errors = validator._errors
+		validator._errors = errors
+		try:
+			method(constraint, field, value)
+		finally:
+			validator._errors = saved_errors
+	return check
+
+
+def _error(errors, field, error):
+	"""Adds the error of the field the same way as Cerberus does, i.e.
+	a single error is stored as is, more errors as a list.
+	"""
+	field_errors = errors.get(field, [])
+	if not isinstance(field_errors, list):
+		field_errors = [field_errors]
+	if isinstance(error, (str, dict)):
+		field_errors.append(error)
+	else:
+		field_errors.extend(error)
+	if len(field_errors) == 1:
+		field_errors = field_errors.pop()
+	errors[field] = field_errors
@@ -69,6 +69,8 @@ resource = {
 			'unique_elements': True,
 		},
 	},
+	# sort keys usable with keyset pagination, see `pagination`
+	'keyset_sorts': (('start_date', ), ),
 	'relations': {
 		'organization': {
 			# The organization where the event is held
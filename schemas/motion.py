@@ -83,6 +83,8 @@ resource = {
 			'unique_elements': True,
 		},
 	},
+	# sort keys usable with keyset pagination, see `pagination`
+	'keyset_sorts': (('date', ), ),
 	'relations': {
 		'organization': {
 			# The organization in which the motion is proposed
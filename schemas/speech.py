@@ -103,6 +103,8 @@ resource = {
 			'unique_elements': True,
 		},
 	},
+	# sort keys usable with keyset pagination, see `pagination`
+	'keyset_sorts': (('date', 'position'), ('updated_at', )),
 	'relations': {
 		'creator': {
 			# The person who is speaking
@@ -94,6 +94,8 @@ resource = {
 			'unique_elements': True,
 		},
 	},
+	# sort keys usable with keyset pagination, see `pagination`
+	'keyset_sorts': (('start_date', ), ),
 	'relations': {
 		'organization': {
 			# The organization whose members are voting
@@ -38,8 +38,81 @@ common = {
 	'FILES_HOST': 'files.parldata.eu',
 	'FILES_DIR': '../files.parldata.eu',
 
+	# serve all parliaments by a single application sharing one database client
+	# instead of a separate application for each parliament
+	'MULTI_TENANT': False,
+
+	# parliaments (e.g. 'cz/psp') whose applications are created at startup of
+	# a WSGI process, others are created on the first request to them
+	'PREWARM_PARLIAMENTS': [],
+
+	# maximal number of parliament applications kept alive by a WSGI process,
+	# the least recently used one is discarded when exceeded (None = no limit)
+	'MAX_PARLIAMENT_INSTANCES': None,
+
+	# compression of responses by gzip, deflate or brotli (if installed) negotiated
+	# by Accept-Encoding header, minimal size of a compressed response in bytes
+	# (streamed responses of unknown size are always compressed) and zlib level
+	'COMPRESSION': True,
+	'COMPRESSION_MIN_SIZE': 1024,
+	'COMPRESSION_LEVEL': 6,
+
+	# maximal size of a gzip- or deflate-compressed request body after
+	# decompression in bytes, larger requests are refused by 413
+	'MAX_REQUEST_SIZE': 100 * 1024 * 1024,
+
+	# number of background workers and maximal number of jobs waiting for them,
+	# more jobs (e.g. mirroring of files) are refused and logged
+	'WORKERS': 4,
+	'WORKER_QUEUE_SIZE': 1000,
+
+	# maximal duration of building of a snapshot of a parliament in seconds,
+	# resources not dumped in time are left from the previous snapshot
+	'SNAPSHOT_TIMEOUT': 600,
+
+	# mirroring of remote files: maximal number of concurrent requests to one host,
+	# number of retries of a failed request, delay before the first retry
+	# (doubled for each next one) and request timeout, both in seconds
+	'MIRROR_HOST_CONCURRENCY': 2,
+	'MIRROR_RETRIES': 3,
+	'MIRROR_RETRY_DELAY': 1,
+	'MIRROR_TIMEOUT': 30,
+
+	# parliaments whose remote files must be compared by content because their
+	# length does not change with the content (padded images)
+	'MIRROR_CONTENT_COMPARE': ['sk/nrsr'],
+
 	'X_DOMAINS': '*',
 
+	# maximal number of related entities kept in the identity map of a request
+	'EMBED_IDENTITY_MAP_SIZE': 10000,
+
+	# maximal number of embedded entities cached across requests by each process
+	'EMBED_CACHE_SIZE': 50000,
+
+	# maximal number of totals of queried documents cached by each process
+	'TOTALS_CACHE_SIZE': 10000,
+
+	# server-side cache of rendered GET responses shared by all parliaments:
+	# backend ('memory' private to each process, 'disk' shared by processes
+	# in RESPONSE_CACHE_DIR or None to disable), maximal number of cached
+	# responses and maximal size of a cached response body in bytes
+	'RESPONSE_CACHE': 'memory',
+	'RESPONSE_CACHE_SIZE': 1000,
+	'RESPONSE_CACHE_DIR': '../response_cache',
+	'RESPONSE_CACHE_MAX_ITEM_SIZE': 1048576,
+
+	# render JSON responses by a faster encoder producing the same output as Eve's
+	'FAST_JSON': True,
+
+	# maximal number of entities of one relation embedded into one document
+	# without paging, more are refused by 400 (None = no limit)
+	'EMBED_LIMIT': None,
+
+	# default and maximal number of entities in a page of embedded relation
+	'EMBED_PAGINATION_DEFAULT': 25,
+	'EMBED_PAGINATION_LIMIT': 1000,
+
 	'DOMAIN': {
 		'people': person.resource,
 		'organizations': organization.resource,
@@ -0,0 +1,180 @@
+"""Snapshots of all data of a parliament for bulk download.
+
+When a scraper run is recorded as finished in `logs`, the documents of
+each resource are dumped by a background worker into gzipped NDJSON
+files (one JSON document per line) served as static files
+
+	FILES_DIR/<prefix>/snapshots/<resource>.ndjson.gz
+
+together with a manifest
+
+	FILES_DIR/<prefix>/snapshots/manifest.json
+
+mapping each resource to its `file`, `count` of documents, `sha256`
+hash and `size` of the file, the latest `updated_at` of documents of
+the resource when the file was written and the `format` version of the
+dumped documents. A resource whose number of documents and latest
+`updated_at` have not changed since the previous snapshot is not dumped
+again unless its file is of an older format.
+
+Documents are dumped in the same form as the API returns them, i.e.
+without internal fields and with `changes` from the history. Dumping
+stops after `SNAPSHOT_TIMEOUT` seconds; the resources not dumped yet
+keep their files from the previous snapshot.
+"""
+
+import os
+import os.path
+import json
+import gzip
+import tempfile
+import time
+import logging
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+import filestore
+import history
+
+SNAPSHOTS_DIR = 'snapshots'
+MANIFEST_FILE = 'manifest.json'
+
+# version of the form of dumped documents, files of another version are
+# dumped again regardless of changes of the data
+FORMAT_VERSION = 2
+
+# number of documents whose changes are retrieved from the history at once
+BATCH_SIZE = 1000
+
+
+class SnapshotTimeout(Exception):
+	"""Raised when building of the snapshot takes too long."""
+
+
+def build_snapshot(job):
+	"""Rewrites snapshot files of resources changed since the previous
+	snapshot and the manifest.
+
+	:param job: dictionary with the database `db`, `resources` to dump,
+		`tracked` resources with history of changes, `log_id` of the
+		finished scraper run and `config` with the API settings
+	"""
+	db, config = job['db'], job['config']
+	deadline = time.time() + config['SNAPSHOT_TIMEOUT']
+	snapshot_dir = os.path.join(config['FILES_DIR'], config['URL_PREFIX'], SNAPSHOTS_DIR)
+	os.makedirs(snapshot_dir, exist_ok=True)
+	manifest = load_manifest(snapshot_dir)
+	resources = manifest.setdefault('resources', {})
+
+	for resource in job['resources']:
+		collection = db[resource]
+		count = collection.count()
+		last_updated = _last_updated(collection, config)
+		previous = resources.get(resource)
+		if previous and previous['count'] == count and previous['last_updated'] == last_updated and \
+				previous.get('format') == FORMAT_VERSION and os.path.exists(os.path.join(snapshot_dir, previous['file'])):
+			continue
+		file_name = resource + '.ndjson.gz'
+		path = os.path.join(snapshot_dir, file_name)
+		try:
+			written = _dump(db, resource, path, resource in job['tracked'], config, deadline)
+		except SnapshotTimeout:
+			logging.warning('Snapshot of %s timed out at %s', config['URL_PREFIX'], resource)
+			break
+		resources[resource] = {
+			'file': file_name,
+			'count': written,
+			'sha256': filestore.file_hash(path),
+			'size': os.path.getsize(path),
+			'last_updated': last_updated,
+			'format': FORMAT_VERSION,
+		}
+
+	for resource in list(resources):
+		if resource not in job['resources']:
+			# e.g. resources excluded from snapshots
+			path = os.path.join(snapshot_dir, resources.pop(resource)['file'])
+			if os.path.exists(path):
+				os.remove(path)
+	manifest['log_id'] = job['log_id']
+	manifest['created_at'] = datetime.utcnow().strftime(config['DATE_FORMAT'])
+	_write_atomically(os.path.join(snapshot_dir, MANIFEST_FILE),
+		lambda f: f.write(json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')))
+
+
+def load_manifest(snapshot_dir):
+	"""Returns the manifest of the snapshot in the given directory or an
+	empty one if there is no snapshot yet.
+	"""
+	try:
+		with open(os.path.join(snapshot_dir, MANIFEST_FILE), 'r') as f:
+			return json.load(f)
+	except (FileNotFoundError, ValueError):
+		return {}
+
+
+def _last_updated(collection, config):
+	"""Returns the latest `updated_at` of documents of the collection
+	as a string or None for an empty collection.
+	"""
+	field = config['LAST_UPDATED']
+	for document in collection.find({}, {'_id': False, field: True}).sort(field, -1).limit(1):
+		value = document.get(field)
+		return value.strftime(config['DATE_FORMAT']) if isinstance(value, datetime) else value
+	return None
+
+
+def _dump(db, resource, path, tracked, config, deadline):
+	"""Writes all documents of the resource into a gzipped NDJSON file
+	at the path and returns their number. Changes from the history are
+	attached to the documents if the resource is `tracked`.
+
+	Raises SnapshotTimeout if the deadline passes before all documents
+	are written, the file is left untouched then.
+	"""
+	def default(value):
+		if isinstance(value, datetime):
+			return value.strftime(config['DATE_FORMAT'])
+		if isinstance(value, ObjectId):
+			return str(value)
+		raise TypeError(repr(value) + ' is not JSON serializable')
+
+	def write_batch(gz, batch):
+		if time.time() > deadline:
+			raise SnapshotTimeout()
+		if tracked:
+			history.attach_changes(db, resource, batch)
+		for document in batch:
+			gz.write(json.dumps(document, default=default, sort_keys=True).encode('utf-8') + b'\n')
+
+	count = 0
+	def write(f):
+		nonlocal count
+		with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+			batch = []
+			for document in db[resource].find({}, {'_id': False, config['ETAG']: False}).sort('id', 1):
+				batch.append(document)
+				if len(batch) == BATCH_SIZE:
+					write_batch(gz, batch)
+					count += len(batch)
+					batch = []
+			write_batch(gz, batch)
+			count += len(batch)
+	_write_atomically(path, write)
+	return count
+
+
+def _write_atomically(path, write):
+	"""Writes the file by the `write` function called with a file open
+	for binary writing. Readers never see a partially written file.
+	"""
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			write(f)
+		os.chmod(tmp_path, 0o644)
+		os.replace(tmp_path, path)
+	except:
+		os.remove(tmp_path)
+		raise
@@ -0,0 +1,109 @@
+"""Support for serving all parliaments by a single application.
+
+The application routes URLs `/<country>/<parliament>/...` and the
+settings specific to the parliament (`URL_PREFIX`, `MONGO_DBNAME` and
+`AUTHORIZED_USERS`) are chosen for each request by the parliament in its
+URL. All parliaments share one MongoClient with its connection pool and
+the database of the parliament is selected per request.
+"""
+
+from eve import Eve
+from eve.io.mongo import Mongo
+from eve.utils import config
+from flask import Config, g, abort, current_app, has_app_context
+
+# URL prefix of the routes of the multi-tenant application.
+URL_PREFIX_PATTERN = '<country>/<parliament>'
+
+# Settings that differ among parliaments.
+TENANT_SETTINGS = ('URL_PREFIX', 'MONGO_DBNAME', 'AUTHORIZED_USERS')
+
+
+def tenant_settings(country_code, parliament):
+	"""Returns the settings specific to the parliament."""
+	return {
+		'URL_PREFIX': country_code + '/' + parliament['code'],
+		'MONGO_DBNAME': country_code + '_' + parliament['code'].replace('-', '_'),
+		'AUTHORIZED_USERS': parliament['authorized_users'],
+	}
+
+
+class TenantConfig(Config):
+	"""Configuration returning settings of the parliament of the current
+	request instead of the common ones, see `TENANT_SETTINGS`.
+	"""
+	def __getitem__(self, key):
+		if key in TENANT_SETTINGS:
+			tenant = _current_tenant()
+			if tenant is not None:
+				return tenant[key]
+		return super().__getitem__(key)
+
+	def get(self, key, default=None):
+		if key in TENANT_SETTINGS:
+			tenant = _current_tenant()
+			if tenant is not None:
+				return tenant[key]
+		return super().get(key, default)
+
+
+class TenantEve(Eve):
+	"""Eve application serving all parliaments listed in `tenants`
+	dictionary mapping URL prefixes of parliaments to their settings.
+	"""
+	def __init__(self, tenants, **kwargs):
+		self.tenants = tenants
+		kwargs.setdefault('data', TenantMongo)
+		super().__init__(**kwargs)
+		self.url_value_preprocessor(_select_tenant)
+
+	def make_config(self, instance_relative=False):
+		config = super().make_config(instance_relative)
+		return TenantConfig(config.root_path, config)
+
+
+class TenantMongo(Mongo):
+	"""Mongo data layer using the database of the parliament of the
+	current request.
+	"""
+	def init_app(self, app):
+		super().init_app(app)
+		self.driver = TenantDriver(self.driver)
+
+
+class TenantDriver(object):
+	"""Wrapper of the shared PyMongo driver whose `db` is the database
+	of the parliament of the current request.
+	"""
+	def __init__(self, driver):
+		self.driver = driver
+
+	@property
+	def cx(self):
+		return self.driver.cx
+
+	@property
+	def db(self):
+		return self.driver.cx[config.MONGO_DBNAME]
+
+
+def _select_tenant(endpoint, values):
+	"""Removes the country and parliament from the URL values passed to
+	the view and makes settings of the parliament current.
+	"""
+	if not values or 'country' not in values:
+		return
+	prefix = values.pop('country') + '/' + values.pop('parliament')
+	tenant = current_app.tenants.get(prefix)
+	if tenant is None:
+		abort(404)
+	g.tenant = tenant
+
+
+def _current_tenant():
+	"""Returns settings of the parliament of the current request or
+	None outside of a request to a parliament.
+	"""
+	if not has_app_context():
+		return None
+	return getattr(g, 'tenant', None)
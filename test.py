@@ -5,6 +5,10 @@
 import unittest
 from datetime import datetime, date, timedelta
 import glob
+import time
+import json
+import gzip
+import urllib.parse
 import requests.exceptions
 from client import vpapi
 
@@ -15,6 +19,18 @@ def datestring_add(datestring, days):
 	return (datetime.strptime(datestring, '%Y-%m-%d') + timedelta(days=days)).date().isoformat()
 
 
+def wait_until(condition, timeout=30):
+	"""Waits until the condition (a function) is true or the timeout in
+	seconds elapses. Returns the last value of the condition.
+	"""
+	start = time.time()
+	while True:
+		result = condition()
+		if result or time.time() - start > timeout:
+			return result
+		time.sleep(0.5)
+
+
 class TestBasicFeatures(unittest.TestCase):
 	def setUp(self):
 		vpapi.parliament('xx/example')
@@ -25,6 +41,17 @@ class TestBasicFeatures(unittest.TestCase):
 		result = vpapi.get('')
 		self.assertEqual(len(result['_links']['child']), 11)
 
+	def test_parliament_list_etag(self):
+		"""repeated request to the list of parliaments with the received ETag should return 304"""
+		url = 'http://%s/xx/' % vpapi.SERVER_NAME
+		resp = requests.get(url)
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(resp.json()['_links']['child'][0]['href'], 'example')
+		resp = requests.get(url, headers={'If-None-Match': resp.headers['etag']})
+		self.assertEqual(resp.status_code, 304)
+		resp = requests.get('http://%s/non-existent/' % vpapi.SERVER_NAME)
+		self.assertEqual(resp.status_code, 404)
+
 	def test_nonexistent_endpoint(self):
 		"""request to a non-existent API endpoint should raise HTTPError"""
 		self.assertRaises(requests.exceptions.HTTPError, vpapi.get, 'non-existent')
@@ -130,6 +157,48 @@ class TestAdvancedFeatures(unittest.TestCase):
 		"""inserting of another entity containing identical identifier to an existing one should raise HTTPError"""
 		self.assertRaises(requests.exceptions.HTTPError, vpapi.post, 'people', self.sample_person)
 
+	def test_bulk_validation_of_disjointness(self):
+		"""bulk inserting of entities containing identical identifiers should raise HTTPError"""
+		identifier = {'identifier': 'bulk-1', 'scheme': 'test'}
+		people = [
+			{'name': 'Bulk Person 1', 'identifiers': [identifier]},
+			{'name': 'Bulk Person 2', 'identifiers': [identifier]},
+		]
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.post, 'people', people)
+		result = vpapi.get('people', where={'identifiers': {'$elemMatch': identifier}})
+		self.assertEqual(result['_items'], [])
+
+		# check a clash with an existing entity in a bulk insert
+		people[1]['identifiers'] = [self.sample_identifier]
+		people[0]['identifiers'] = [{'identifier': 'bulk-2', 'scheme': 'test'}]
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.post, 'people', people)
+
+	def test_bulk_validation_of_data_relation(self):
+		"""bulk inserting of entities referencing a non-existent entity should raise HTTPError"""
+		memberships = [
+			{'person_id': self.person_id, 'organization_id': self.organization_id, 'label': 'Bulk membership 1'},
+			{'person_id': self.person_id, 'organization_id': 'non-existent', 'label': 'Bulk membership 2'},
+		]
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.post, 'memberships', memberships)
+		result = vpapi.get('memberships', where={'label': 'Bulk membership 1'})
+		self.assertEqual(result['_items'], [])
+
+	def test_bulk_validation_issues(self):
+		"""issues of an invalid entity in bulk insert should be the same as when inserted alone"""
+		invalid = {
+			'name': 'Invalid person',
+			'birth_date': '1.1.1960',
+			'contact_details': [{'type': 'phone', 'value': ''}],
+			'unknown_field': 1,
+		}
+		with self.assertRaises(requests.exceptions.HTTPError) as single:
+			vpapi.post('people', invalid)
+		with self.assertRaises(requests.exceptions.HTTPError) as bulk:
+			vpapi.post('people', [{'name': 'Valid person'}, invalid])
+		self.assertEqual(
+			bulk.exception.response.json()['_items'][1]['_issues'],
+			single.exception.response.json()['_issues'])
+
 	def test_validation_of_unique_elements(self):
 		"""inserting of duplicate element into the list of links should raise HTTPError"""
 		resource = 'people/%s' % self.person_id
@@ -222,6 +291,128 @@ class TestAdvancedFeatures(unittest.TestCase):
 		result = vpapi.get('people/%s' % self.person_id)
 		self.assertIn(expected_change, result.get('changes'))
 
+	def test_keyset_pagination(self):
+		"""walking through items by cursor should return the same items as walking by pages"""
+		vpapi.post('people', [{'name': 'Keyset person %d' % i} for i in range(5)])
+		where = {'name': {'$regex': '^Keyset person'}}
+		by_pages = [p['id'] for p in vpapi.getall('people', where=where, sort='id', max_results=2)]
+		by_cursor = [p['id'] for p in vpapi.getall('people', where=where, max_results=2, after='')]
+		first = vpapi.get('people', where=where, max_results=2, after='')
+		query = urllib.parse.parse_qs(urllib.parse.urlparse(first['_links']['next']['href']).query)
+		second = vpapi.get('people', where=where, max_results=2, after=query['after'][0])
+		for id in by_pages:
+			vpapi.delete('people/%s' % id)
+		self.assertEqual(len(by_pages), 5)
+		self.assertEqual(by_cursor, by_pages)
+		self.assertEqual(first['_meta']['total'], 5)
+		self.assertEqual(second['_meta']['total'], 5)
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.get, 'people', after='', sort='name')
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.get, 'people', after='invalid')
+
+	def test_keyset_pagination_with_projection(self):
+		"""walking through items by cursor with a projection should return the requested fields, id and timestamps"""
+		def walk(resource, **kwargs):
+			items, after = [], ''
+			while after is not None:
+				resp = vpapi.get(resource, max_results=2, after=after, **kwargs)
+				items.extend(resp['_items'])
+				after = None
+				if 'next' in resp['_links']:
+					query = urllib.parse.parse_qs(urllib.parse.urlparse(resp['_links']['next']['href']).query)
+					after = query['after'][0]
+			return items
+
+		vpapi.post('people', [{'name': 'Projected person %d' % i} for i in range(3)])
+		people = walk('people', where={'name': {'$regex': '^Projected person'}}, projection={'name': 1})
+		vpapi.post('speeches', [{'text': 'Projected speech %d' % i} for i in range(3)])
+		speeches = walk('speeches', where={'text': {'$regex': '^Projected speech'}}, sort='updated_at',
+			projection={'text': 1})
+		for p in people:
+			vpapi.delete('people/%s' % p['id'])
+		for s in speeches:
+			vpapi.delete('speeches/%s' % s['id'])
+		self.assertEqual(len(people), 3)
+		self.assertTrue(all('id' in p and 'name' in p for p in people))
+		self.assertEqual(len(speeches), 3)
+		self.assertTrue(all('id' in s and 'updated_at' in s and 'text' in s for s in speeches))
+
+	def test_total_modes(self):
+		"""total should be omitted with total=none and the cached total should reflect inserted items"""
+		vpapi.post('people', [{'name': 'Counted person %d' % i} for i in range(3)])
+		where = {'name': {'$regex': '^Counted person'}}
+		result = vpapi.get('people', where=where, max_results=2, total='none')
+		self.assertNotIn('total', result['_meta'])
+		self.assertNotIn('last', result['_links'])
+		self.assertIn('next', result['_links'])
+		result = vpapi.get('people', where=where, total='cached')
+		self.assertEqual(result['_meta']['total'], 3)
+		vpapi.post('people', {'name': 'Counted person 3'})
+		result = vpapi.get('people', where=where, total='cached')
+		self.assertEqual(result['_meta']['total'], 4)
+		for person in result['_items']:
+			vpapi.delete('people/%s' % person['id'])
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.get, 'people', total='invalid')
+
+	def test_export(self):
+		"""export should return all matching items as NDJSON or CSV"""
+		result = vpapi.post('people', [{'name': 'Exported person %d' % i} for i in range(60)])
+		url = 'http://%s/xx/example/export/people' % vpapi.SERVER_NAME
+		where = '{"name": {"$regex": "^Exported person"}}'
+		resp = requests.get(url, params={'where': where})
+		lines = resp.text.splitlines()
+		resp = requests.get(url, params={'where': where, 'after': '', 'total': 'none'})
+		paged_lines = resp.text.splitlines()
+		resp = requests.get(url, params={'where': where, 'projection': '{"name": 1}', 'format': 'csv'})
+		rows = resp.text.splitlines()
+		for item in result['_items']:
+			vpapi.delete('people/%s' % item['id'])
+		self.assertEqual(len(lines), 60)
+		self.assertEqual(paged_lines, lines)
+		self.assertTrue(all(json.loads(line)['name'].startswith('Exported person') for line in lines))
+		self.assertEqual(rows[0], 'id,name')
+		self.assertEqual(len(rows), 61)
+		self.assertTrue(all('_id' not in json.loads(line) and '_etag' not in json.loads(line) for line in lines))
+
+		# check that changes stored in history are exported
+		vpapi.patch('people/%s' % self.person_id, {'email': 'new@example.com'}, effective_date='2000-01-01')
+		resp = requests.get(url, params={'where': json.dumps({'id': self.person_id})})
+		person = json.loads(resp.text)
+		self.assertIn({'property': 'email', 'value': 'jqpublic@xyz.example.com', 'end_date': '1999-12-31'},
+			person.get('changes'))
+
+	def test_as_of(self):
+		"""if parameter `as_of` is sent in URL query string then the values valid at the given date should be returned"""
+		vpapi.patch(
+			'people/%s' % self.person_id,
+			{'email': 'new@example.com'},
+			effective_date='2000-01-01')
+		result = vpapi.get('people/%s' % self.person_id, as_of='1999-06-30')
+		self.assertEqual(result['email'], 'jqpublic@xyz.example.com')
+		result = vpapi.get('people/%s' % self.person_id, as_of='2000-01-01')
+		self.assertEqual(result['email'], 'new@example.com')
+
+	def test_changes_of_embedded_entities(self):
+		"""embedded entities should list their changes stored in history too"""
+		vpapi.patch(
+			'people/%s' % self.person_id,
+			{'email': 'new@example.com'},
+			effective_date='2000-01-01')
+		expected_change = {
+			'property': 'email',
+			'value': 'jqpublic@xyz.example.com',
+			'end_date': '1999-12-31'
+		}
+		result = vpapi.get('memberships/%s?embed=["person"]' % self.membership_id)
+		self.assertIn(expected_change, result['person'].get('changes'))
+		result = vpapi.get('memberships/%s?embed={"person": {"projection": {"name": 1}}}' % self.membership_id)
+		self.assertNotIn('changes', result['person'])
+
+		# check that embedded entities are resolved as of the given date too
+		result = vpapi.get('memberships/%s?embed=["person"]' % self.membership_id, as_of='1999-06-30')
+		self.assertEqual(result['person']['email'], 'jqpublic@xyz.example.com')
+		result = vpapi.get('memberships/%s?embed=["person"]' % self.membership_id, as_of='2000-01-01')
+		self.assertEqual(result['person']['email'], 'new@example.com')
+
 	def test_fix_on_put(self):
 		"""if parameter `effective_date` in URL query string has value `fix`, the change should not be logged into the `changes` field"""
 		modified = self.sample_person.copy()
@@ -243,38 +434,124 @@ class TestAdvancedFeatures(unittest.TestCase):
 		self.assertNotIn('changes', result)
 
 	def test_file_mirroring(self):
-		"""URLs in the mirrored fields should be relocated and the referenced files downloaded"""
+		"""URLs in the mirrored fields should be relocated and the referenced files downloaded in background"""
+		def image():
+			return vpapi.get('people/%s' % self.person_id)['image']
+
 		# check that the file has been relocated and downloaded
 		mirrored_url = 'http://files.parldata.eu/xx/example/people/%s/image.png' % self.person_id
 		pathfile = '../files.parldata.eu/xx/example/people/%s/image' % self.person_id
-		result = vpapi.get('people/%s' % self.person_id)
-		self.assertEqual(result['image'], mirrored_url)
+		self.assertTrue(wait_until(lambda: image() == mirrored_url))
 		self.assertEqual(len(glob.glob(pathfile + '.*')), 1)
 
 		# check that the file is not mirrored again if the source hasn't changed
 		vpapi.patch('people/%s' % self.person_id, {'image': self.sample_image_url})
-		result = vpapi.get('people/%s' % self.person_id)
-		self.assertEqual(result['image'], mirrored_url)
+		self.assertEqual(image(), mirrored_url)
+		time.sleep(5)
+		self.assertEqual(image(), mirrored_url)
 		self.assertEqual(len(glob.glob(pathfile + '.*')), 1)
 
 		# check that new file is mirrored if the source file changes
 		new_image = 'http://upload.wikimedia.org/wikipedia/en/b/bc/Wiki.png'
 		vpapi.patch('people/%s' % self.person_id, {'image': new_image})
-		result = vpapi.get('people/%s' % self.person_id)
-		self.assertEqual(result['image'], mirrored_url.replace('.png', '.2.png'))
+		self.assertEqual(image(), mirrored_url)
+		new_mirrored_url = mirrored_url.replace('.png', '.2.png')
+		self.assertTrue(wait_until(lambda: image() == new_mirrored_url))
 		self.assertEqual(len(glob.glob(pathfile + '.*')), 2)
 
 		# check that non-existent remote URLs are not mirrored
 		nonexistent_image = 'http://example.notexists'
 		vpapi.patch('people/%s' % self.person_id, {'image': nonexistent_image})
-		result = vpapi.get('people/%s' % self.person_id)
-		self.assertEqual(result['image'], nonexistent_image)
+		self.assertTrue(wait_until(lambda: image() == nonexistent_image))
 		self.assertEqual(len(glob.glob(pathfile + '.*')), 2)
 
 		# check that mirrored files are deleted with entity deletion
 		vpapi.delete('people/%s' % self.person_id)
 		self.assertEqual(len(glob.glob(pathfile + '.*')), 0)
 
+	def test_compression(self):
+		"""large responses should be compressed as negotiated by Accept-Encoding header"""
+		url = 'http://%s/xx/example/people/%s' % (vpapi.SERVER_NAME, self.person_id)
+		params = {'embed': '["memberships.organization"]'}
+		resp = requests.get(url, params=params, headers={'Accept-Encoding': 'gzip'})
+		self.assertEqual(resp.headers['content-encoding'], 'gzip')
+		self.assertEqual(resp.json()['id'], self.person_id)
+		etag = resp.headers['etag']
+		self.assertTrue(etag.endswith('-gzip"'))
+		resp = requests.get(url, params=params, headers={'Accept-Encoding': 'identity'})
+		self.assertNotIn('content-encoding', resp.headers)
+		self.assertNotEqual(resp.headers['etag'], etag)
+
+		# check that tags of both representations match the current version
+		resp = requests.get(url, params=params, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+		self.assertEqual(resp.status_code, 304)
+		self.assertEqual(resp.headers['etag'], etag)
+		resp = requests.get(url, params=params, headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+		self.assertEqual(resp.status_code, 304)
+
+	def test_compressed_payload(self):
+		"""bulk insert with gzip-compressed body should be accepted"""
+		threshold = vpapi.COMPRESSION_THRESHOLD
+		vpapi.COMPRESSION_THRESHOLD = 0
+		try:
+			result = vpapi.post('people', [{'name': 'Compressed person %d' % i} for i in range(3)])
+		finally:
+			vpapi.COMPRESSION_THRESHOLD = threshold
+		self.assertEqual(len(result['_items']), 3)
+		for item in result['_items']:
+			vpapi.delete('people/%s' % item['id'])
+
+	def test_response_cache(self):
+		"""repeated GET request should be served from the cache until the resource changes"""
+		url = 'http://%s/xx/example/people/%s' % (vpapi.SERVER_NAME, self.person_id)
+		resp = requests.get(url)
+		resp = requests.get(url)
+		self.assertEqual(resp.headers['x-response-cache'], 'hit')
+		vpapi.patch('people/%s' % self.person_id, {'name': 'Cached person'})
+		resp = requests.get(url)
+		self.assertEqual(resp.headers['x-response-cache'], 'miss')
+		self.assertEqual(resp.json()['name'], 'Cached person')
+
+	def test_collection_etag(self):
+		"""repeated request of an unchanged collection with the received ETag should return 304"""
+		url = 'http://%s/xx/example/people' % vpapi.SERVER_NAME
+		params = {'where': '{"id": "%s"}' % self.person_id}
+		resp = requests.get(url, params=params)
+		etag = resp.headers['etag']
+		resp = requests.get(url, params=params, headers={'If-None-Match': etag})
+		self.assertEqual(resp.status_code, 304)
+		vpapi.patch('people/%s' % self.person_id, {'name': 'Changed person'})
+		resp = requests.get(url, params=params, headers={'If-None-Match': etag})
+		self.assertEqual(resp.status_code, 200)
+		self.assertNotEqual(resp.headers['etag'], etag)
+
+	def test_snapshot(self):
+		"""finished scraper run should rebuild snapshot of the changed collections in background"""
+		snapshot_dir = '../files.parldata.eu/xx/example/snapshots/'
+		def manifest(log_id):
+			try:
+				with open(snapshot_dir + 'manifest.json') as f:
+					result = json.load(f)
+			except (FileNotFoundError, ValueError):
+				return None
+			return result if result.get('log_id') == log_id else None
+
+		log = vpapi.post('logs', {'status': 'running'})
+		vpapi.patch('logs/%s' % log['id'], {'status': 'finished'})
+		result = wait_until(lambda: manifest(log['id']))
+		self.assertTrue(result)
+		people = result['resources']['people']
+		self.assertEqual(people['count'], vpapi.get('people')['_meta']['total'])
+		with gzip.open(snapshot_dir + people['file'], 'rt') as f:
+			lines = f.readlines()
+		self.assertEqual(len(lines), people['count'])
+		for line in lines:
+			person = json.loads(line)
+			self.assertNotIn('_id', person)
+			self.assertNotIn('_etag', person)
+		self.assertNotIn('logs', result['resources'])
+		vpapi.delete('logs/%s' % log['id'])
+
 	def test_embedding(self):
 		"""related entities specified in URL query parameter `embed` should be embedded in to the returned document"""
 		# check two-level embedding
@@ -297,6 +574,114 @@ class TestAdvancedFeatures(unittest.TestCase):
 		self.assertNotIn('person', result['memberships'][0])
 		self.assertIn('organization_id', result['memberships'][0])
 
+	def test_embedding_after_update(self):
+		"""embedded entity should reflect changes of the entity made after previous embedding"""
+		result = vpapi.get('memberships/%s?embed=["organization"]' % self.membership_id)
+		self.assertEqual(result['organization']['name'], 'ABC, Inc.')
+		vpapi.patch('organizations/%s' % self.organization_id, {'name': 'XYZ, Inc.'})
+		result = vpapi.get('memberships/%s?embed=["organization"]' % self.membership_id)
+		self.assertEqual(result['organization']['name'], 'XYZ, Inc.')
+		vpapi.patch('organizations/%s' % self.organization_id, {'name': 'ABC, Inc.'})
+
+	def test_paged_embedding(self):
+		"""embedding options of a plural relation should return one page of related entities"""
+		result = vpapi.get('people/%s?embed={"memberships": {"max_results": 1, "sort": "-start_date"}}' % self.person_id)
+		self.assertIn('memberships', result)
+		self.assertIsInstance(result['memberships'], dict)
+		self.assertEqual(len(result['memberships']['_items']), 1)
+		self.assertEqual(result['memberships']['_meta']['total'], 1)
+		self.assertEqual(result['memberships']['_meta']['max_results'], 1)
+		self.assertNotIn('person_id', result['memberships']['_items'][0])
+		self.assertNotIn('next', result['memberships']['_links'])
+
+		# check projection of embedded entities
+		result = vpapi.get('people/%s?embed={"memberships.organization": {"projection": {"name": 1}}}' % self.person_id)
+		organization = result['memberships'][0]['organization']
+		self.assertEqual(set(organization), {'id', 'name'})
+
+		# check that invalid options are refused
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.get,
+			'people/%s?embed={"memberships": {"max_results": 0}}' % self.person_id)
+		self.assertRaises(requests.exceptions.HTTPError, vpapi.get,
+			'people/%s?embed={"memberships": {"max_results": true}}' % self.person_id)
+
+		# check that each document of a collection gets its own page
+		result = vpapi.get('people', embed={'memberships': {'max_results': 1}})
+		for person in result['_items']:
+			self.assertIn('memberships', person)
+			self.assertLessEqual(len(person['memberships']['_items']), 1)
+			self.assertEqual(person['memberships']['_meta']['total'],
+				vpapi.get('memberships', where={'person_id': person['id']})['_meta']['total'])
+
+	def test_embedded_counts(self):
+		"""numbers of related entities specified in URL query parameter `embed_count` should be returned"""
+		result = vpapi.get('people', where={'id': self.person_id}, embed_count=['memberships', 'votes'])
+		self.assertEqual(result['_items'][0]['_counts'], {'memberships': 1, 'votes': 0})
+
+
+class TestPathDispatcher(unittest.TestCase):
+	class FakeClient:
+		closed = False
+
+		def close(self):
+			self.closed = True
+
+	class FakeApp:
+		def __init__(self, *args):
+			self.client = TestPathDispatcher.FakeClient()
+			self.extensions = {'pymongo': {'MONGO': (self.client, None)}}
+
+		def __call__(self, environ, start_response):
+			start_response('200 OK', [('Content-Type', 'text/plain')])
+			return [b'ok']
+
+	def setUp(self):
+		import wsgi
+		self.wsgi = wsgi
+		self.create_app = wsgi.create_app
+		self.create_multi_tenant_app = wsgi.create_multi_tenant_app
+		wsgi.create_app = self.FakeApp
+		wsgi.create_multi_tenant_app = self.FakeApp
+
+	def tearDown(self):
+		self.wsgi.create_app = self.create_app
+		self.wsgi.create_multi_tenant_app = self.create_multi_tenant_app
+
+	def request(self, dispatcher, pfx):
+		environ = {'PATH_INFO': '/%s/people' % pfx, 'REQUEST_METHOD': 'GET'}
+		return dispatcher(environ, lambda status, headers, exc_info=None: None)
+
+	def test_lazy_instances(self):
+		"""discarded application should be closed after the requests it serves finish"""
+		dispatcher = self.wsgi.PathDispatcher(limit=1)
+		dispatcher.parliaments = {'aa/one': ('aa', {}), 'aa/two': ('aa', {}), 'aa/three': ('aa', {})}
+		response = self.request(dispatcher, 'aa/one')
+		first = dispatcher.get_instance('aa/one')
+		self.request(dispatcher, 'aa/two').close()
+		self.assertNotIn('aa/one', dispatcher.instances)
+		self.assertFalse(first.client.closed)
+		self.assertEqual(b''.join(response), b'ok')
+		response.close()
+		self.assertTrue(first.client.closed)
+
+		# application not serving any request is closed immediately
+		second = dispatcher.get_instance('aa/two')
+		self.request(dispatcher, 'aa/three').close()
+		self.assertTrue(second.client.closed)
+		self.assertIsNone(dispatcher.get_instance('aa/unknown'))
+
+	def test_multi_tenant(self):
+		"""single application should serve all parliaments and never be closed"""
+		dispatcher = self.wsgi.PathDispatcher(limit=1, multi_tenant=True)
+		dispatcher.parliaments = {'aa/one': ('aa', {}), 'aa/two': ('aa', {})}
+		app = dispatcher.get_instance('aa/one')
+		self.assertIs(dispatcher.get_instance('aa/two'), app)
+		self.assertIsNone(dispatcher.get_instance('aa/unknown'))
+		for pfx in ('aa/one', 'aa/two'):
+			response = self.request(dispatcher, pfx)
+			self.assertEqual(b''.join(response), b'ok')
+		self.assertFalse(app.client.closed)
+
 
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,77 @@
+"""A pool of background threads executing jobs that need not to be
+finished before the response to the request is sent, e.g. downloading
+of remote files.
+"""
+
+import threading
+import queue
+import logging
+from collections import deque
+
+
+class WorkerPool(object):
+	"""A fixed number of threads executing jobs from a bounded queue.
+
+	Jobs submitted with the same key are executed one after another in
+	the order of submission, never concurrently. Jobs with different
+	keys may run in parallel.
+
+	At most `queue_size` jobs wait for execution, including the ones
+	waiting for a job with the same key. If there are that many, newly
+	submitted jobs are refused immediately instead of blocking the
+	submitting request.
+	"""
+	def __init__(self, num_workers, queue_size):
+		self.queue = queue.Queue()
+		# free places for waiting jobs
+		self.slots = threading.Semaphore(queue_size)
+		self.lock = threading.Lock()
+		# jobs waiting for the running job with the same key, by key
+		self.waiting = {}
+		self.threads = []
+		for i in range(num_workers):
+			thread = threading.Thread(target=self._work, name='worker-%d' % i)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def submit(self, key, func, *args):
+		"""Schedules execution of `func(*args)` after all previously
+		submitted jobs with the same key are finished. Returns False if
+		the job is refused because too many jobs are waiting.
+		"""
+		job = (key, func, args)
+		if not self.slots.acquire(blocking=False):
+			logging.warning('Background job %s refused, too many jobs are waiting', key)
+			return False
+		with self.lock:
+			if key in self.waiting:
+				self.waiting[key].append(job)
+				return True
+			self.waiting[key] = deque()
+		self.queue.put(job)
+		return True
+
+	def join(self):
+		"""Blocks until all submitted jobs are finished."""
+		self.queue.join()
+
+	def _work(self):
+		"""Executes jobs from the queue forever."""
+		while True:
+			job = self.queue.get()
+			while job:
+				key, func, args = job
+				self.slots.release()
+				try:
+					func(*args)
+				except Exception:
+					logging.exception('Background job %s failed', key)
+				# Continue with the next job with the same key, if any
+				with self.lock:
+					if self.waiting[key]:
+						job = self.waiting[key].popleft()
+					else:
+						del self.waiting[key]
+						job = None
+			self.queue.task_done()
@@ -3,32 +3,59 @@
 """This file represents a WSGI interaface of the API. It creates a
 separate application for each parliament and incoming requests are
 dispatched to the respective application by a middleware based on path
-in the URL.
+in the URL. In multi-tenant mode a single application serves all
+parliaments instead. Responses of all applications are compressed and
+compressed request bodies are accepted.
 """
 
 import sys
 import os.path
 import json
-from werkzeug.wsgi import get_path_info
+import threading
+from collections import OrderedDict
+from werkzeug.wsgi import get_path_info, ClosingIterator
 from werkzeug.exceptions import NotFound
 
 # Extend the path to find our imported modules.
 sys.path.insert(0, os.path.dirname(__file__))
-from run import create_app, hateoas_app
+import settings
+from run import create_app, create_multi_tenant_app, hateoas_app
+from middleware import CompressionMiddleware, DecompressionMiddleware
 
 class PathDispatcher(object):
 	"""Middleware routing from the URL to particular application
 	corresponding to the parliament.
+
+	Applications are created on the first request to the parliament
+	unless they are listed in `prewarm` to be created immediately. If
+	`limit` is given, at most that many applications are kept alive and
+	the least recently used one is discarded when another one is needed.
+	Connections of a discarded application to the database are closed
+	when the last request being served by it finishes.
+
+	In `multi_tenant` mode a single application serves all parliaments
+	and it is never discarded.
 	"""
-	def __init__(self):
-		"""Creates application instances for all parliaments."""
-		self.instances = {}
+	def __init__(self, prewarm=(), limit=None, multi_tenant=False):
+		"""Creates application instances for parliaments to prewarm."""
 		with open(os.path.join(os.path.dirname(__file__), 'conf', 'parliaments.json'), 'r') as f:
 			parliaments = json.load(f)
+		self.parliaments = {}
 		for c, cp in parliaments.items():
 			for p in cp:
-				pfx = c + '/' + p['code']
-				self.instances[pfx] = create_app(c, p)
+				self.parliaments[c + '/' + p['code']] = (c, p)
+		self.multi_tenant_app = create_multi_tenant_app(parliaments) if multi_tenant else None
+		self.limit = limit
+		self.instances = OrderedDict()
+		self.lock = threading.Lock()
+		# locks of applications being created, by prefix
+		self.creating = {}
+		# numbers of requests being served, by application
+		self.serving = {}
+		# discarded applications still serving requests
+		self.discarded = set()
+		for pfx in prewarm:
+			self.get_instance(pfx)
 
 	def __call__(self, environ, start_response):
 		"""Returns application instance respective to the parliament in
@@ -36,10 +63,102 @@ class PathDispatcher(object):
 		"""
 		segments = get_path_info(environ).strip('/').split('/', 2)
 		if len(segments) < 2:
-			app = hateoas_app
-		else:
-			pfx = segments[0] + '/' + segments[1]
-			app = self.instances.get(pfx, NotFound())
-		return app(environ, start_response)
+			return hateoas_app(environ, start_response)
+		pfx = segments[0] + '/' + segments[1]
+		if self.multi_tenant_app:
+			app = self.get_instance(pfx) or NotFound()
+			return app(environ, start_response)
+		app = self.get_instance(pfx, serve=True)
+		if app is None:
+			return NotFound()(environ, start_response)
+		try:
+			app_iter = app(environ, start_response)
+		except:
+			self._release(app)
+			raise
+		return ClosingIterator(app_iter, lambda: self._release(app))
+
+	def get_instance(self, pfx, serve=False):
+		"""Returns application instance of the parliament with the given
+		prefix, creates it if it does not exist yet. Returns None for an
+		unknown parliament.
+
+		If `serve` is true, the application is counted as serving
+		a request until `_release` is called, so that it is not closed
+		meanwhile.
+
+		Only one thread creates the application while other requests to
+		the same parliament wait for it. Requests to other parliaments
+		are not blocked.
+		"""
+		if self.multi_tenant_app:
+			return self.multi_tenant_app if pfx in self.parliaments else None
+		with self.lock:
+			if pfx in self.instances:
+				self.instances.move_to_end(pfx)
+				return self._acquire(self.instances[pfx], serve)
+			if pfx not in self.parliaments:
+				return None
+			creating = self.creating.setdefault(pfx, threading.Lock())
+
+		with creating:
+			with self.lock:
+				if pfx in self.instances:
+					return self._acquire(self.instances[pfx], serve)
+			app = create_app(*self.parliaments[pfx])
+			evicted = []
+			with self.lock:
+				self.instances[pfx] = app
+				del self.creating[pfx]
+				self._acquire(app, serve)
+				while self.limit and len(self.instances) > self.limit:
+					instance = self.instances.popitem(last=False)[1]
+					# Applications serving requests are closed when they finish
+					if self.serving.get(instance):
+						self.discarded.add(instance)
+					else:
+						evicted.append(instance)
+
+		for instance in evicted:
+			self._close(instance)
+		return app
+
+	def _acquire(self, app, serve):
+		"""Counts the request being served by the application if `serve`
+		is true. Must be called with the lock held. Returns the application.
+		"""
+		if serve:
+			self.serving[app] = self.serving.get(app, 0) + 1
+		return app
+
+	def _release(self, app):
+		"""Marks the request served by the application as finished and
+		closes the application if it has been discarded and it was the
+		last request served by it.
+		"""
+		with self.lock:
+			self.serving[app] -= 1
+			if self.serving[app]:
+				return
+			del self.serving[app]
+			if app not in self.discarded:
+				return
+			self.discarded.remove(app)
+		self._close(app)
+
+	@staticmethod
+	def _close(app):
+		"""Closes connections to the database held by the application."""
+		for cx, db in app.extensions.get('pymongo', {}).values():
+			cx.close()
 
-application = PathDispatcher()
+application = PathDispatcher(
+	settings.common['PREWARM_PARLIAMENTS'],
+	settings.common['MAX_PARLIAMENT_INSTANCES'],
+	settings.common['MULTI_TENANT'])
+application = DecompressionMiddleware(application, settings.common['MAX_REQUEST_SIZE'])
+if settings.common['COMPRESSION']:
+	application = CompressionMiddleware(
+		application,
+		settings.common['COMPRESSION_MIN_SIZE'],
+		settings.common['COMPRESSION_LEVEL'])